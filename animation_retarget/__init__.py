@@ -39,6 +39,10 @@ Bone names between the two skeletons are matched using fuzzy string matching,
 allowing it to automatically find combinations if bone names are similar.
 
 Usage: First select the source armature (with the animation), then select the target armature (where the animation will be transferred to) as active object.
+
+To retarget a folder of BVH files without user interaction, use the
+batch_retarget.py script. BVH files can also be retargeted without importing
+them in Blender, see bvh.py.
 """
 
 import bpy
@@ -73,6 +77,13 @@ class ANIM_OT_retarget_animation_mh(bpy.types.Operator):
     trg_rig = bpy.props.StringProperty(name="Target rig", description="Armature object to transfer the animation to", default="")
     insert_rests = bpy.props.BoolProperty(name="Insert rest frames", description="Insert a rest frame between every two frames", default=False)
     in_place = bpy.props.BoolProperty(name="Animate in-place", description="Keep animation in-place and ignore translations", default=False)
+    evaluation = bpy.props.EnumProperty(name="Evaluate source", description="How to sample the pose of the source armature",
+        items=[(animation_retarget_mh.EVAL_FCURVES, "F-Curves", "Evaluate the F-curves of the source action directly (fast)"),
+               (animation_retarget_mh.EVAL_SCENE, "Scene", "Evaluate the scene on every frame, including constraints and drivers (slow)")],
+        default=animation_retarget_mh.EVAL_FCURVES)
+    reduce_keys = bpy.props.BoolProperty(name="Reduce keyframes", description="Remove redundant keyframes after retargeting", default=False)
+    reduce_tolerance = bpy.props.FloatProperty(name="Tolerance", description="Maximum error allowed per channel when reducing keyframes", default=animation_retarget_mh.KEY_REDUCTION_TOLERANCE, min=0.0, precision=4)
+    chunk_size = bpy.props.IntProperty(name="Chunk size", description="Number of frames to retarget at once, lower values use less memory on long animations", default=animation_retarget_mh.RETARGET_CHUNK_SIZE, min=1)
 
     def execute(self, context):
         """Transfer current animation from source armature (selected) to the
@@ -86,7 +97,16 @@ class ANIM_OT_retarget_animation_mh(bpy.types.Operator):
             return {'FINISHED'}
 
         self.report({'INFO'}, "Retarget animation from %s to %s" % (self.src_rig, self.trg_rig))
-        animation_retarget_mh.retarget_animation(bpy.data.objects[self.src_rig], bpy.data.objects[self.trg_rig], self.insert_rests, self.in_place)
+        wm = context.window_manager
+        def progress(done, total):
+            wm.progress_update(100.0 * done / total)
+            print ("Retargetting frame %s/%s" % (done, total))
+        wm.progress_begin(0, 100)
+        try:
+            animation_retarget_mh.retarget_animation(bpy.data.objects[self.src_rig], bpy.data.objects[self.trg_rig], self.insert_rests, self.in_place, chunk_size=self.chunk_size, progress=progress, evaluation=self.evaluation,
+                                                   reduce_tolerance=self.reduce_tolerance if self.reduce_keys else None)
+        finally:
+            wm.progress_end()
         return {'FINISHED'}
 
     def invoke(self, context, event):
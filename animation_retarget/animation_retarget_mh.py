@@ -40,10 +40,25 @@ allowing it to automatically find combinations if bone names are similar.
 """
 
 import bpy
-import mathutils
-from difflib import SequenceMatcher
+import os
+import gc
+import re
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
 
-BONE_NAME_SIMILARITY_THRESHOLD = 0.7
+import bone_matching
+import pose_math
+import bvh
+from pose_math import matrices_to_quaternions, matrices_to_eulers, quaternions_to_matrices, axis_angles_to_matrices, eulers_to_matrices
+from bone_matching import BONE_NAME_SIMILARITY_THRESHOLD
+
+RETARGET_CHUNK_SIZE = 250   # Number of frames to sample and solve at once
+
+# Source pose evaluation modes
+EVAL_FCURVES = 'FCURVES'    # Evaluate the F-curves of the source action directly
+EVAL_SCENE = 'SCENE'        # Evaluate the scene on every frame (includes constraints and drivers)
 
 
 # Credit goes to Thomas Larsson for these derivations
@@ -93,48 +108,402 @@ def _get_rest_pose_compensation_matrix(src_pbone, trg_pbone):
     a_mat = src_pbone.matrix.inverted() * trg_pbone.matrix
     return a_mat
 
-def set_rotation(pose_bone, rot, frame_idx, group=None):
-    """Apply rotation to PoseBone and insert a keyframe.
-    Rotation can be a matrix, a quaternion or a tuple of euler angles
+def _matrix_array(mat):
+    """Convert a mathutils Matrix to a 4x4 numpy array.
     """
-    if not group:
-        group = pose_bone.name
+    return np.array(mat.to_4x4(), dtype=np.float64)
 
-    if pose_bone.rotation_mode == 'QUATERNION':
-        try:
-            quat = rot.to_quaternion()
-        except:
-            quat = rot
-        pose_bone.rotation_quaternion = quat
-        pose_bone.keyframe_insert('rotation_quaternion', frame=frame_idx, group=group)
+def get_pose_matrices(pose_bones):
+    """Return the armature space matrices (PoseBone.matrix) of all bones in
+    the pose as a (B, 4, 4) array, in a single foreach_get call.
+    """
+    buf = np.empty(len(pose_bones) * 16, dtype=np.float32)
+    pose_bones.foreach_get('matrix', buf)
+    # RNA stores matrices in column-major order
+    return buf.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+
+# Values of the pose bone channels in rest pose
+REST_VALUES = {
+    'rotation_quaternion': (1.0, 0.0, 0.0, 0.0),
+    'rotation_axis_angle': (0.0, 0.0, 1.0, 0.0),
+    'rotation_euler': (0.0, 0.0, 0.0),
+    'location': (0.0, 0.0, 0.0),
+    'scale': (1.0, 1.0, 1.0),
+    }
+
+_POSE_BONE_PATH = re.compile(r'^pose\.bones\["(.+)"\]\.(\w+)$')
+
+def evaluate_pose_matrices(rig, frames):
+    """Calculate the armature space matrices (M_b) of all pose bones of the rig
+    for the specified frames directly from the F-curves of its active action
+    and the rest pose hierarchy, without evaluating the scene.
+    Returns an (F, B, 4, 4) array with the bones in rig.pose.bones order.
+
+    Channels without F-curve are in rest pose. Constraints, drivers and the
+    bone inherit options are ignored.
+    """
+    pose_bones = rig.pose.bones
+    frames = list(frames)
+    n_frames = len(frames)
+
+    fcurves = {}
+    if rig.animation_data and rig.animation_data.action:
+        for fcurve in rig.animation_data.action.fcurves:
+            match = _POSE_BONE_PATH.match(fcurve.data_path)
+            if match and not fcurve.mute:
+                fcurves.setdefault(match.groups(), {})[fcurve.array_index] = fcurve
+
+    def _channel(pose_bone, prop):
+        values = np.tile(np.array(REST_VALUES[prop], dtype=np.float64), (n_frames, 1))
+        for index, fcurve in fcurves.get((pose_bone.name, prop), {}).items():
+            values[:, index] = [fcurve.evaluate(frame) for frame in frames]
+        return values
+
+    # Local pose matrices L_b, relative to parent and rest
+    basis = np.empty((n_frames, len(pose_bones), 4, 4), dtype=np.float64)
+    for b_idx, pose_bone in enumerate(pose_bones):
+        if pose_bone.rotation_mode == 'QUATERNION':
+            rot = quaternions_to_matrices(_channel(pose_bone, 'rotation_quaternion'))
+        elif pose_bone.rotation_mode == 'AXIS_ANGLE':
+            rot = axis_angles_to_matrices(_channel(pose_bone, 'rotation_axis_angle'))
+        else:
+            rot = eulers_to_matrices(_channel(pose_bone, 'rotation_euler'), pose_bone.rotation_mode)
+        basis[:, b_idx] = pose_math.compose_matrices(rot, _channel(pose_bone, 'location'), _channel(pose_bone, 'scale'))
+
+    # M_b = M_p R_p^-1 R_b L_b, evaluated from the root down
+    indices = dict((name, b_idx) for b_idx, name in enumerate(pose_bones.keys()))
+    parent_indices = [indices[pose_bone.parent.name] if pose_bone.parent else -1 for pose_bone in pose_bones]
+    rest = np.array([_matrix_array(pose_bone.bone.matrix_local) for pose_bone in pose_bones]).reshape(-1, 4, 4)
+    return pose_math.global_matrices(basis, rest, parent_indices)
+
+def get_rest_matrices(bones):
+    """Return the rest matrices (Bone.matrix_local, relative armature) of all
+    bones of an armature as a (B, 4, 4) array.
+    """
+    buf = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get('matrix_local', buf)
+    return buf.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+
+def _get_fcurves(action, existing, data_path, count, group):
+    """Return the F-curves for all array indices of the specified data path,
+    creating them where needed. existing maps (data_path, array_index) to the
+    F-curves already in the action.
+    """
+    fcurves = []
+    for index in range(count):
+        fcurve = existing.get((data_path, index))
+        if fcurve is None:
+            fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+        fcurves.append(fcurve)
+    return fcurves
+
+# Keyframe properties that are copied in bulk, with their size and type
+KEYFRAME_PROPS = (
+    ('co', 2, np.float32),
+    ('handle_left', 2, np.float32),
+    ('handle_right', 2, np.float32),
+    ('interpolation', 1, np.int32),
+    ('handle_left_type', 1, np.int32),
+    ('handle_right_type', 1, np.int32),
+    ('type', 1, np.int32),
+    ('easing', 1, np.int32),
+    )
+
+def _keyframe_props():
+    """Return the KEYFRAME_PROPS available in this version of Blender.
+    """
+    names = bpy.types.Keyframe.bl_rna.properties.keys()
+    return [prop for prop in KEYFRAME_PROPS if prop[0] in names]
+
+def _get_keyframes(fcurve):
+    """Return the properties of all keyframes of an F-curve as a dict of
+    (K, n) arrays, read with one foreach_get() call per property.
+    """
+    keyframe_points = fcurve.keyframe_points
+    keys = {}
+    for name, size, dtype in _keyframe_props():
+        buf = np.empty(len(keyframe_points) * size, dtype=dtype)
+        keyframe_points.foreach_get(name, buf)
+        keys[name] = buf.reshape(-1, size)
+    return keys
+
+def _set_keyframes(fcurve, keys):
+    """Write keyframe properties, as returned by _get_keyframes(), to an
+    F-curve in place, with one foreach_set() call per property. The number of
+    keyframes is adjusted to the keys. The F-curve itself is kept, with its
+    modifiers, extrapolation, color and group.
+    """
+    keyframe_points = fcurve.keyframe_points
+    n_keys, n_old = len(keys['co']), len(keyframe_points)
+    if n_keys > n_old:
+        keyframe_points.add(n_keys - n_old)
+    elif n_keys < n_old:
+        if hasattr(keyframe_points, 'clear'):
+            keyframe_points.clear()
+            keyframe_points.add(n_keys)
+        else:
+            # There is no bulk removal before Blender 2.90. Removing the last
+            # keyframe does not move the others, so this is linear in the
+            # number of keyframes removed.
+            for index in range(n_old - 1, n_keys - 1, -1):
+                keyframe_points.remove(keyframe_points[index], fast=True)
+    for name, values in keys.items():
+        keyframe_points.foreach_set(name, np.ascontiguousarray(values).ravel())
+    fcurve.update()
+
+def _get_fcurve_keys(fcurve):
+    """Return the (frames, values) of all keyframes of an F-curve.
+    """
+    co = np.empty(len(fcurve.keyframe_points) * 2, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co', co)
+    return co[0::2], co[1::2]
+
+def _set_fcurve_keys(fcurve, frames, values):
+    """Fill an F-curve with keyframes in bulk, similar to keyframe_insert():
+    keys on other frames are kept as they are, keys on the specified frames
+    get the new values but keep their other settings, and new keys get the
+    defaults of keyframe_points.add(). Frames should be unique.
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    old_frames = _get_fcurve_keys(fcurve)[0]
+    n_old = len(old_frames)
+    if n_old:
+        sorter = np.argsort(old_frames, kind='mergesort')
+        pos = sorter[np.minimum(np.searchsorted(old_frames, frames, sorter=sorter), n_old - 1)]
+        hit = (old_frames[pos] == frames)
     else:
-        try:
-            euler = rot.to_euler(pose_bone.rotation_mode)
-        except:
-            euler = rot
-        pose_bone.rotation_euler = euler
-        pose_bone.keyframe_insert('rotation_euler', frame=frame_idx, group=group)
-
-def set_translation(pose_bone, trans, frame_idx, group=None):
-    """Insert a translation keyframe for a pose bone
+        pos = np.zeros(len(frames), dtype=np.intp)
+        hit = np.zeros(len(frames), dtype=bool)
+
+    # The added keyframes follow the existing ones
+    n_added = len(frames) - np.count_nonzero(hit)
+    if n_added:
+        fcurve.keyframe_points.add(n_added)
+    keys = _get_keyframes(fcurve)
+
+    # Keyframe rows of the untouched keys followed by those of the new values
+    kept = np.flatnonzero(~np.isin(old_frames, frames))
+    rows = np.concatenate([kept, np.where(hit, pos, n_old + np.cumsum(~hit) - 1)])
+    co = np.concatenate([keys['co'][kept], np.column_stack([frames, values]).astype(np.float32)])
+    order = np.argsort(co[:, 0], kind='mergesort')
+    rows, co = rows[order], co[order]
+
+    keys = dict((name, prop_values[rows]) for name, prop_values in keys.items())
+    # Move the handles along with their keyframe
+    offset = co - keys['co']
+    for name in ('handle_left', 'handle_right'):
+        if name in keys:
+            keys[name] = keys[name] + offset
+    keys['co'] = co
+    _set_keyframes(fcurve, keys)
+
+def decimate_curves(frames, values, tolerance):
+    """Find the keyframes needed to reproduce a set of curves sampled on the
+    same frames within a tolerance, with linear interpolation in between.
+    frames is a (K,) array, values a (C, K) array with C curves and tolerance a
+    scalar or a (C,) array with the maximum error per curve.
+    Returns a (C, K) boolean array marking the keyframes to keep.
+
+    This is a Ramer-Douglas-Peucker style decimation using the value error of
+    every key, evaluated for all curves at once: every iteration each segment
+    that is not within tolerance is split at its worst key.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_curves, n_keys = values.shape
+    keep = np.zeros((n_curves, n_keys), dtype=bool)
+    if n_keys == 0:
+        return keep
+    keep[:, 0] = keep[:, -1] = True
+    frames = np.asarray(frames, dtype=np.float64)
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.float64).reshape(-1, 1), (n_curves, 1))
+
+    key_idx = np.arange(n_keys)
+    rows = np.arange(n_curves)[:, np.newaxis]
+    while True:
+        # Kept keys enclosing every key
+        left = np.maximum.accumulate(np.where(keep, key_idx, 0), axis=1)
+        right = np.minimum.accumulate(np.where(keep, key_idx, n_keys-1)[:, ::-1], axis=1)[:, ::-1]
+
+        x0, x1 = frames[left], frames[right]
+        span = np.where(x1 > x0, x1 - x0, 1.0)
+        y0, y1 = values[rows, left], values[rows, right]
+        error = np.abs(values - (y0 + (frames - x0) / span * (y1 - y0)))
+        error[keep] = 0.0
+
+        over = np.flatnonzero(error > tolerance)
+        if not len(over):
+            return keep
+
+        # Keep the key with the largest error in every segment that is over
+        segment = left.ravel()[over] + n_keys * (over // n_keys)
+        order = np.lexsort((error.ravel()[over], segment))
+        segment = segment[order]
+        last = np.append(segment[1:] != segment[:-1], True)
+        keep.ravel()[over[order][last]] = True
+
+KEY_REDUCTION_TOLERANCE = 1e-3
+KEY_REDUCTION_CHUNK_SIZE = 64   # Number of curves to decimate at once
+LINEAR_INTERPOLATION = 'LINEAR'
+
+def reduce_keyframes(action, tolerance=KEY_REDUCTION_TOLERANCE, tolerances=None, linear=True, chunk_size=KEY_REDUCTION_CHUNK_SIZE):
+    """Remove redundant keyframes from all F-curves of the action, keeping
+    every curve within tolerance of its original keyframes. tolerances can map
+    a property name (eg. 'location') to a specific tolerance for its channels.
+    Curves with identical keyframe frames, such as those written by
+    retargeting, are reduced in bulk, chunk_size curves at a time, and the
+    remaining keyframes are written back in place with foreach_set().
+    With linear == True the remaining keyframes are set to linear
+    interpolation, for which the tolerance is guaranteed.
+    Returns the compression ratio (number of keyframes before / after).
+    """
+    if tolerances is None:
+        tolerances = {}
+    interpolation = bpy.types.Keyframe.bl_rna.properties['interpolation'].enum_items[LINEAR_INTERPOLATION].value
+
+    # Group curves by their keyframe frames
+    groups = {}
+    n_before = 0
+    for fcurve in action.fcurves:
+        n_before += len(fcurve.keyframe_points)
+        if len(fcurve.keyframe_points) < 3:
+            continue
+        frames = _get_fcurve_keys(fcurve)[0]
+        groups.setdefault(hashlib.sha1(frames.tobytes()).digest(), (frames, []))[1].append(fcurve)
+
+    for frames, fcurves in groups.values():
+        for start in range(0, len(fcurves), max(1, chunk_size)):
+            chunk = fcurves[start:start+chunk_size]
+            values = np.array([_get_fcurve_keys(fcurve)[1] for fcurve in chunk])
+            keep = decimate_curves(frames, values, [tolerances.get(fcurve.data_path.rsplit('.', 1)[-1], tolerance) for fcurve in chunk])
+            for fcurve, curve_keep in zip(chunk, keep):
+                if curve_keep.all():
+                    continue
+                keys = dict((name, prop_values[curve_keep]) for name, prop_values in _get_keyframes(fcurve).items())
+                if linear:
+                    keys['interpolation'][:] = interpolation
+                _set_keyframes(fcurve, keys)
+    n_after = sum(len(fc.keyframe_points) for fc in action.fcurves)
+
+    ratio = float(n_before) / n_after if n_after else 1.0
+    print ("Reduced %s keyframes to %s (compression ratio %.2f)" % (n_before, n_after, ratio))
+    return ratio
+
+def pose_channels(bone_mappings, pose_mats, in_place=False):
+    """Convert target pose matrices to F-curve channel values.
+    pose_mats is an (F, B, 4, 4) array of target pose matrices as returned by
+    AnimationRetarget.solve(). Returns a list of (pose_bone, property, values)
+    tuples, with values an (F, n) float32 array holding the n array indices of
+    the property for every frame.
+    """
+    return pose_bone_channels([b_map.trg_pbone for b_map in bone_mappings], pose_mats, in_place)
+
+def pose_bone_channels(pose_bones, pose_mats, in_place=False):
+    """Convert target pose matrices of the specified target pose bones to
+    F-curve channel values, see pose_channels().
+    """
+    channels = []
+    for b_idx, pose_bone in enumerate(pose_bones):
+        mats = pose_mats[:, b_idx]
+
+        if pose_bone.rotation_mode == 'QUATERNION':
+            channels.append((pose_bone, 'rotation_quaternion', matrices_to_quaternions(mats)))
+        elif pose_bone.rotation_mode == 'AXIS_ANGLE':
+            quats = matrices_to_quaternions(mats)
+            axis_angles = np.empty_like(quats)
+            axis_angles[:, 0] = 2 * np.arccos(np.clip(quats[:, 0], -1.0, 1.0))
+            sin_half = np.linalg.norm(quats[:, 1:], axis=-1)
+            axis_angles[:, 1:] = np.where(sin_half[:, np.newaxis] > 1e-8, quats[:, 1:] / np.maximum(sin_half, 1e-8)[:, np.newaxis], (0.0, 1.0, 0.0))
+            channels.append((pose_bone, 'rotation_axis_angle', axis_angles))
+        else:
+            channels.append((pose_bone, 'rotation_euler', matrices_to_eulers(mats, pose_bone.rotation_mode)))
+
+        if not in_place and not pose_bone.parent:
+            channels.append((pose_bone, 'location', mats[:, :3, 3]))
+
+    return [(pose_bone, prop, values.astype(np.float32)) for pose_bone, prop, values in channels]
+
+def write_channels(trg_amt, channels, frames, rest_frames=()):
+    """Write channel values, as returned by pose_channels(), to the action of
+    the target armature in bulk. frames are the F target frame numbers to key
+    the values on. Optionally rest_frames lists target frame numbers to key the
+    rest pose on.
+
+    Instead of calling keyframe_insert() for every bone, frame and channel, the
+    F-curves for every channel are created where needed and filled in place
+    with one foreach_set() call per keyframe property, covering quaternion,
+    axis angle, euler and location channels.
+    """
+    if not trg_amt.animation_data:
+        trg_amt.animation_data_create()
+    action = trg_amt.animation_data.action
+    if not action:
+        action = bpy.data.actions.new(name="%sAction" % trg_amt.name)
+        trg_amt.animation_data.action = action
+    existing = dict(((fc.data_path, fc.array_index), fc) for fc in action.fcurves)
+
+    frames = np.asarray(frames, dtype=np.float32)
+    rest_frames = np.asarray(rest_frames, dtype=np.float32)
+    all_frames = np.concatenate([frames, rest_frames])
+    order = np.argsort(all_frames, kind='mergesort')
+    all_frames = all_frames[order]
+
+    for pose_bone, prop, values in channels:
+        if prop == 'rotation_quaternion':
+            # Keep consecutive keys in the same hemisphere for interpolation
+            flip = np.sum(values[1:] * values[:-1], axis=-1) < 0
+            values = values.copy()
+            values[1:] *= np.where(np.logical_xor.accumulate(flip), -1.0, 1.0)[:, np.newaxis]
+        elif prop == 'rotation_euler':
+            values = np.unwrap(values, axis=0)
+
+        rest = np.tile(REST_VALUES[prop], (len(rest_frames), 1))
+        values = np.concatenate([values, rest])[order]
+
+        data_path = 'pose.bones["%s"].%s' % (pose_bone.name, prop)
+        fcurves = _get_fcurves(action, existing, data_path, values.shape[1], pose_bone.name)
+        for index, fcurve in enumerate(fcurves):
+            _set_fcurve_keys(fcurve, all_frames, values[:, index])
+
+def get_frame_range(rig):
+    """Determine the range of frames animated by the active action of the
+    specified rig, from the keyframes on its F-curves, or the frame range of
+    the action if it has no keyframes. Returns a (first, last) tuple of ints,
+    or None if the rig is not animated.
     """
-    if not group:
-        group = pose_bone.name
-
-    try:
-        trans = trans.to_translation()
-    except:
-        pass
-    pose_bone.location = trans
-    pose_bone.keyframe_insert("location", frame=frame_idx, group=group)
-
-def fuzzy_stringmatch_ratio(str1, str2):
-    """Compare two strings using a fuzzy matching algorithm. Returns the
-    similarity of both strings as a float, with 1 meaning identical match,
-    and 0 meaning no similarity at all.
+    if not rig.animation_data or not rig.animation_data.action:
+        return None
+    action = rig.animation_data.action
+
+    first, last = None, None
+    for fcurve in action.fcurves:
+        n_keys = len(fcurve.keyframe_points)
+        if not n_keys:
+            continue
+        co = np.empty(n_keys * 2, dtype=np.float32)
+        fcurve.keyframe_points.foreach_get('co', co)
+        frames = co[0::2]
+        first = frames.min() if first is None else min(first, frames.min())
+        last = frames.max() if last is None else max(last, frames.max())
+
+    if first is None:
+        first, last = action.frame_range
+    return (int(np.floor(first)), int(np.ceil(last)))
+
+def get_target_frames(frames, insert_restframes=False):
+    """Target frame numbers for the retargeted source frames, starting at
+    frame 1, with a rest frame before every frame if requested. Returns a
+    (target_frames, rest_frames) tuple of lists.
     """
-    m = SequenceMatcher(None, str1, str2)
-    return m.ratio()
+    target_frames = []
+    rest_frames = []
+    tf_idx = 1
+    for frame_idx in frames:
+        if insert_restframes and frame_idx > 2:
+            rest_frames.append(tf_idx)
+            tf_idx += 1
+        target_frames.append(tf_idx)
+        tf_idx += 1
+    return (target_frames, rest_frames)
 
 def select_and_set_rest_pose(rig, scn):
     """Select the rig, go into pose mode and clear all rotations (sets to rest
@@ -150,8 +519,8 @@ def select_and_set_rest_pose(rig, scn):
 def sort_by_depth(bonemaplist):
     """Sort bone mapping list by depth of target bone.
     Creating a breadth-first list through the target skeleton.
-    This order is needed for correct retargeting, so that we build up the
-    _trg_mat and _src_mat top to bottom.
+    This order is needed for correct retargeting, as the solver builds up the
+    target matrices from the parents down.
     """
     def _depth(bonemap):
         """Depth of target bone in the skeleton, is 0 for root bone.
@@ -162,12 +531,101 @@ def sort_by_depth(bonemaplist):
     sort_tuples = [(_depth(bm), bm) for bm in bonemaplist]
     return [x[1] for x in sorted(sort_tuples, key=lambda b: b[0])]
 
+def _rig_signature(rig):
+    """Signature of the structure and rest pose of an armature.
+    """
+    bones = rig.data.bones
+    sha = hashlib.sha1()
+    for bone in bones:
+        sha.update(('%s:%s\n' % (bone.name, bone.parent.name if bone.parent else '')).encode('utf-8'))
+    sha.update(np.round(get_rest_matrices(bones), 5).astype(np.float32).tobytes())
+    return sha.hexdigest()
+
+class RestData(object):
+    """Rest pose constants of all bone mappings between a source and target
+    rig, stored in contiguous arrays in bone_mappings order:
+        src_indices     index of the source bone in src_amt.pose.bones
+        parent_indices  index of the mapping of the target parent, -1 for roots
+        a_mats          rest pose compensation matrices A_b
+        b_mats          bone matrices B_b
+    These only change when the rest pose or structure of one of the rigs
+    changes, so they are cached on disk per rig pair.
+    """
+    FIELDS = ('src_indices', 'parent_indices', 'a_mats', 'b_mats')
+
+    def __init__(self, signature, **arrays):
+        self.signature = signature
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+
+    @classmethod
+    def from_bone_mappings(cls, signature, src_amt, bone_mappings):
+        """Collect the static matrices of the bone mappings, after
+        BoneMapping.update_matrices() was called.
+        """
+        src_names = src_amt.pose.bones.keys()
+        map_indices = dict((bm.trg_bone.name, idx) for idx, bm in enumerate(bone_mappings))
+        return cls(signature,
+            src_indices = np.array([src_names.index(bm.src_bone.name) for bm in bone_mappings], dtype=np.int32),
+            parent_indices = np.array([map_indices[bm.trg_parent.trg_bone.name] if bm.trg_parent else -1 for bm in bone_mappings], dtype=np.int32),
+            a_mats = np.array([_matrix_array(bm.a_mat) for bm in bone_mappings]).reshape(-1, 4, 4),
+            b_mats = np.array([_matrix_array(bm.b_mat) for bm in bone_mappings]).reshape(-1, 4, 4))
+
+    @staticmethod
+    def cache_path(cache_dir, signature):
+        return os.path.join(cache_dir, 'restdata_%s.npz' % signature)
+
+    def save(self, cache_dir):
+        """Save the rest data in cache_dir. The file is written under a
+        temporary name and then renamed, so batch workers sharing the cache
+        never read a partly written file.
+        """
+        tmp_path = None
+        try:
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    # Another worker may have created it in the meantime
+                    if not os.path.isdir(cache_dir):
+                        raise
+            arrays = dict((field, getattr(self, field)) for field in self.FIELDS)
+            fd, tmp_path = tempfile.mkstemp(suffix='.npz', prefix='restdata_', dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.cache_path(cache_dir, self.signature))
+        except (IOError, OSError):
+            print ("Could not write rest pose cache to %s" % cache_dir)
+            if tmp_path and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, cache_dir, signature):
+        """Load cached rest data for the signature, returns None if it is not
+        cached.
+        """
+        path = cls.cache_path(cache_dir, signature)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return cls(signature, **dict((field, data[field]) for field in cls.FIELDS))
+        except (IOError, OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            print ("Ignoring invalid rest pose cache %s" % path)
+            return None
+
+
 class AnimationRetarget(object):
     """Manages the retargetting operation between two armatures.
     """
-    def __init__(self, src_amt, trg_amt):
+    def __init__(self, src_amt, trg_amt, cache_dir=bone_matching.CACHE_DIR):
+        """Bone mappings and rest pose data are cached in cache_dir per rig
+        pair, set cache_dir to None to disable caching.
+        """
         self.src_amt = src_amt
         self.trg_amt = trg_amt
+        self.cache_dir = cache_dir
+        self.rest_data = None
 
         self.bone_mappings = []
         self.trg_bone_lookup = {}  # Lookup a mapping by target bone name
@@ -190,69 +648,150 @@ class AnimationRetarget(object):
     def find_bone_mapping(self):
         """Find combination of source and target bones by comparing the bones
         from both armatures with a fuzzy string matching algorithm.
+        The mapping is cached per combination of source and target rig (see
+        bone_matching), so it is only determined once for every rig pair.
         """
         # TODO allow more complicated remappings by allowing to specify a mapping file
-        not_mapped_trg = {}
-        mapped_src = {}
-        for trg_bone in self.trg_amt.pose.bones:
-            if trg_bone.name in self.src_amt.pose.bones:
-                src_bone = self.src_amt.pose.bones[trg_bone.name]
-                self.bone_mappings.append(BoneMapping(src_bone, trg_bone, self))
-                print ("Bone mapped: %s -> %s" % (src_bone.name, trg_bone.name))
-                mapped_src[src_bone.name] = True
-            else:
-                not_mapped_trg[trg_bone.name] = trg_bone
-
-        for trg_bone in not_mapped_trg.values():
-            src_candidates = [b for b in self.src_amt.pose.bones if b.name not in mapped_src]
-            best_candidate = None
-            score = -1
-            for b_idx, src_bone in enumerate(src_candidates):
-                ratio = fuzzy_stringmatch_ratio(src_bone.name, trg_bone.name)
-                if ratio > score:
-                    score = ratio
-                    best_candidate = b_idx
-            if best_candidate is not None and score > BONE_NAME_SIMILARITY_THRESHOLD:
-                src_bone = src_candidates[best_candidate]
-                self.bone_mappings.append(BoneMapping(src_bone, trg_bone, self))
-                print ("Bone mapped: %s -> %s" % (src_bone.name, trg_bone.name))
-                del src_candidates[best_candidate]
-            else:
-                print ("Could not find an approriate source bone for %s" % trg_bone.name)
-
-    def _retarget_frame(self, scn, frame_idx, target_frame, in_place=False):
-        scn.frame_set(frame_idx)
-        for b_map in self.bone_mappings:
-            b_map.retarget(target_frame, in_place)
-
-    def _set_rest_frame(self, target_frame, in_place=False):
-        pose_mat = mathutils.Matrix()
-        pose_mat.identity()
-        for b_map in self.bone_mappings:
-            b_map.insert_keyframe(target_frame, pose_mat, in_place)
+        src_bones = self.src_amt.pose.bones
+        trg_bones = self.trg_amt.pose.bones
+        mapping = bone_matching.find_bone_mapping(src_bones.keys(), trg_bones.keys(), BONE_NAME_SIMILARITY_THRESHOLD, self.cache_dir)
+
+        mapped_trg = set()
+        for src_name, trg_name in mapping:
+            self.bone_mappings.append(BoneMapping(src_bones[src_name], trg_bones[trg_name], self))
+            print ("Bone mapped: %s -> %s" % (src_name, trg_name))
+            mapped_trg.add(trg_name)
+
+        for trg_name in trg_bones.keys():
+            if trg_name not in mapped_trg:
+                print ("Could not find an approriate source bone for %s" % trg_name)
+
+    def rest_signature(self):
+        """Signature of the rest poses of both rigs and the bone mapping
+        between them.
+        """
+        sha = hashlib.sha1()
+        sha.update(_rig_signature(self.src_amt).encode('utf-8'))
+        sha.update(_rig_signature(self.trg_amt).encode('utf-8'))
+        for bm in self.bone_mappings:
+            sha.update(('%s>%s\n' % (bm.src_bone.name, bm.trg_bone.name)).encode('utf-8'))
+        return sha.hexdigest()
 
-    def retarget(self, scn, frames, insert_restframes=False, in_place=False):
-        """Start the retarget operation for specified frames.
+    def update_matrices(self):
+        """Update the static matrices of all bone mappings, and collect them in
+        arrays for the batched solver. Both rigs should be in rest pose.
+        """
+        for bm in self.bone_mappings:
+            bm.update_matrices()
+        self._set_rest_data(RestData.from_bone_mappings(self.rest_signature(), self.src_amt, self.bone_mappings))
+
+    def _set_rest_data(self, rest_data):
+        self.rest_data = rest_data
+        self.src_indices = rest_data.src_indices
+        self.parent_indices = rest_data.parent_indices
+        self.a_mats = rest_data.a_mats
+        self.b_mats = rest_data.b_mats
+
+    def setup_rest_data(self, scn):
+        """Set up the rest pose data of the rig pair, from the cache if
+        possible. Otherwise both rigs are put in rest pose to calculate it, and
+        the result is cached.
         """
+        signature = self.rest_signature()
+        rest_data = RestData.load(self.cache_dir, signature) if self.cache_dir else None
+        if rest_data is not None and len(rest_data.src_indices) == len(self.bone_mappings):
+            print ("Using cached rest pose data")
+            self._set_rest_data(rest_data)
+            return
+
         scn.frame_set(0)
         select_and_set_rest_pose(self.src_amt, scn)
         select_and_set_rest_pose(self.trg_amt, scn)
+        self.update_matrices()
+        if self.cache_dir:
+            self.rest_data.save(self.cache_dir)
+
+    def sample_source_matrices(self, scn, frames, evaluation=EVAL_SCENE):
+        """Sample the pose of the mapped source bones for all specified frames.
+        Returns an (F, B, 4, 4) array of armature space matrices (M_b), with
+        bones in the order of bone_mappings.
+        With evaluation == EVAL_FCURVES the pose is calculated from the F-curves
+        of the source action, without changing the scene frame. With
+        EVAL_SCENE the scene is evaluated on every frame.
+        """
+        if evaluation == EVAL_FCURVES:
+            return evaluate_pose_matrices(self.src_amt, frames)[:, self.src_indices]
+
+        src_mats = np.empty((len(frames), len(self.bone_mappings), 4, 4), dtype=np.float64)
+        for f_idx, frame_idx in enumerate(frames):
+            scn.frame_set(frame_idx)
+            src_mats[f_idx] = get_pose_matrices(self.src_amt.pose.bones)[self.src_indices]
+        return src_mats
+
+    def solve(self, src_mats):
+        """Retarget a batch of source poses in one go.
+        src_mats is an (F, B, 4, 4) array of source bone matrices as returned by
+        sample_source_matrices(). Returns the (F, B, 4, 4) target pose matrices
+        (L_b, relative to parent and rest) for every frame.
+
+        For every bone:
+            T_b = M_b A_b (with the translation of M_b)
+            L_b = B_b T_p^-1 T_b
+        Bone mappings are sorted by depth, so parents always precede their
+        children.
+        """
+        return pose_math.retarget_matrices(src_mats, self.a_mats, self.b_mats, self.parent_indices)
 
-        for bm in self.bone_mappings:
-            bm.update_matrices()
+    def retarget(self, scn, frames, insert_restframes=False, in_place=False, chunk_size=RETARGET_CHUNK_SIZE, progress=None, evaluation=EVAL_FCURVES):
+        """Start the retarget operation for specified frames.
+        Frames are sampled and solved in chunks of chunk_size frames, after
+        which only the compact channel values are kept, so that long takes
+        can be retargeted in bounded memory.
+        progress is an optional callback that is called with the number of
+        frames done and the total number of frames after every chunk.
+        evaluation selects how the source pose is sampled, see
+        sample_source_matrices(). F-curve evaluation falls back to scene
+        evaluation if the source rig has no action.
+        """
+        self.setup_rest_data(scn)
 
         if insert_restframes:
             print ("Rest keyframe insertion is enabled")
 
-        tf_idx = 1
-        for c, frame_idx in enumerate(frames):
-            print ("Retargetting frame %s/%s" % (c, len(frames)))
-            if insert_restframes and frame_idx > 2:
-                self._set_rest_frame(tf_idx, in_place)
-                tf_idx += 1
+        if evaluation == EVAL_FCURVES and not (self.src_amt.animation_data and self.src_amt.animation_data.action):
+            evaluation = EVAL_SCENE
+        print ("Evaluating source pose from %s" % evaluation.lower())
+
+        frames = list(frames)
+        chunk_size = max(1, chunk_size)
+        channels = None
+        for start in range(0, len(frames), chunk_size):
+            chunk = frames[start:start+chunk_size]
+            pose_mats = self.solve(self.sample_source_matrices(scn, chunk, evaluation))
+            chunk_channels = pose_channels(self.bone_mappings, pose_mats, in_place)
+            if channels is None:
+                channels = [(pose_bone, prop, [values]) for pose_bone, prop, values in chunk_channels]
+            else:
+                for channel, (_, _, values) in zip(channels, chunk_channels):
+                    channel[2].append(values)
 
-            self._retarget_frame(scn, frame_idx, tf_idx, in_place)
-            tf_idx += 1
+            # Release the pose matrices of this chunk before starting the next
+            del pose_mats, chunk_channels
+            gc.collect()
+
+            if progress:
+                progress(start + len(chunk), len(frames))
+            else:
+                print ("Retargetting frame %s/%s" % (start + len(chunk), len(frames)))
+
+        if channels is None:
+            return
+        channels = [(pose_bone, prop, np.concatenate(values)) for pose_bone, prop, values in channels]
+
+        target_frames, rest_frames = get_target_frames(frames, insert_restframes)
+
+        print ("Writing keyframes for %s frames" % len(frames))
+        write_channels(self.trg_amt, channels, target_frames, rest_frames)
 
 
 class BoneMapping(object):
@@ -270,8 +809,6 @@ class BoneMapping(object):
         self.src_pbone = src_pbone
         self.trg_pbone = trg_pbone
 
-        self.src_mat = None
-        self.trg_mat = None
         self.a_mat = None
         self.b_mat = None
 
@@ -297,12 +834,9 @@ class BoneMapping(object):
         of one of the two rigs changes.
         Should be called when both rigs are in rest pose.
         """
-        self.a_mat = _get_rest_pose_compensation_matrix(self.src_pbone, self.trg_pbone)
+        self.a_mat = _get_rest_pose_compensation_matrix(self.src_pbone, self.trg_pbone).to_4x4()
         self.b_mat = _get_bone_matrix(self.trg_bone)
 
-        #self.src_mat = _get_bone_matrix(self.src_pbone)
-        #self.b_mat = 
-
     def __repr__(self):
         return self.__unicode__()
 
@@ -312,48 +846,6 @@ class BoneMapping(object):
     def __unicode__(self):
         return '<BoneMapping %s -> %s>' % (self.src_bone.name, self.trg_bone.name)
 
-    def insert_keyframe(self, frame_idx, pose_mat, in_place=False):
-        """Insert the specified matrix as a keyframe for the target bone.
-        """
-        set_rotation(self.trg_pbone, pose_mat, frame_idx)
-        if not in_place and not self.trg_bone.parent:
-            set_translation(self.trg_pbone, pose_mat, frame_idx)
-
-    def retarget(self, frame_idx, in_place=False):
-        """Retarget the current pose of the source bone to the target bone, and
-        apply it as keyframe with specified index.
-        """
-        frame_mat = self.src_pbone.matrix.to_4x4()
-        pose_mat = self.retarget_frame(frame_mat)
-        self.insert_keyframe(frame_idx, pose_mat, in_place)
-
-    def retarget_frame(self, frame_mat):
-        """Calculate a pose matrix for the target bone by retargeting the
-        specified frame_mat, which is a pose on the source bone.
-        """
-        # Store these for reuse in child bones, should be recalculated for every frame
-        self._src_mat = frame_mat
-        self._trg_mat = self._src_mat * self.a_mat.to_4x4()
-        self._trg_mat.col[3] = frame_mat.col[3]
-        trg_parent = self.trg_parent
-        if trg_parent:
-            mat = trg_parent._trg_mat.inverted() * self._trg_mat
-        else:
-            mat = self._trg_mat
-        mat = self.b_mat * mat
-
-        # TODO apply rotation locks and corrections
-        #mat = correctMatrixForLocks(mat, self.order, self.locks, self.trgBone, self.useLimits)
-
-        # Don't know why, but apparently we need to modify _trg_mat another time
-        mat_ = self.b_mat.inverted() * mat
-        if trg_parent:
-            self._trg_mat = trg_parent._trg_mat * mat_
-        else:
-            self._trg_mat = mat_
-
-        return mat
-
 def get_armatures(context):
     trg_rig = context.active_object
     selected_objs = context.selected_objects[:]
@@ -369,14 +861,84 @@ def get_armatures(context):
 
     return (src_rig, trg_rig)
 
-def retarget_animation(src_rig, trg_rig, insert_restframes=False, in_place=False):
+def retarget_animation(src_rig, trg_rig, insert_restframes=False, in_place=False, frames=None, chunk_size=RETARGET_CHUNK_SIZE, progress=None, evaluation=EVAL_FCURVES, reduce_tolerance=None):
     """With insert_restframes == True the first frame, which is supposed to contain the
     rest pose, is copied in between every two frames. This makes it possible to
     blend in each pose using action constraints.
     If in_place == True translations of the root bone are ignored.
+    If no frames are specified, all frames animated by the action of the source
+    rig are retargeted, or the scene frame range if it has no action.
+    With evaluation == EVAL_FCURVES (default) the source pose is calculated from
+    the source action directly, use EVAL_SCENE to include constraints and
+    drivers on the source rig.
+    If a reduce_tolerance is specified, redundant keyframes are removed from the
+    resulting action afterwards, see reduce_keyframes().
     """
+    scn = bpy.context.scene
+    if frames is None:
+        frame_range = get_frame_range(src_rig)
+        if frame_range is None:
+            frame_range = (scn.frame_start, scn.frame_end)
+        frames = range(frame_range[0], frame_range[1]+1)
     r = AnimationRetarget(src_rig, trg_rig)
-    r.retarget(bpy.context.scene, range(1,500+1), insert_restframes, in_place)  # TODO determine how many frames to copy
+    r.retarget(scn, frames, insert_restframes, in_place, chunk_size, progress, evaluation)
+    if reduce_tolerance and trg_rig.animation_data and trg_rig.animation_data.action:
+        reduce_keyframes(trg_rig.animation_data.action, reduce_tolerance)
+
+def get_skeleton(rig):
+    """Describe the pose bones of the rig as a (names, parent_indices, rest)
+    tuple, with rest the (B, 4, 4) rest matrices (Bone.matrix_local), for use
+    with bvh.BvhRetarget.
+    """
+    pose_bones = rig.pose.bones
+    names = pose_bones.keys()
+    indices = dict((name, b_idx) for b_idx, name in enumerate(names))
+    parent_indices = np.array([indices[pose_bone.parent.name] if pose_bone.parent else -1 for pose_bone in pose_bones], dtype=np.int32)
+    rest = np.array([_matrix_array(pose_bone.bone.matrix_local) for pose_bone in pose_bones]).reshape(-1, 4, 4)
+    return (names, parent_indices, rest)
+
+def save_skeleton(rig, path):
+    """Save the skeleton of the rig to an .npz file, to retarget BVH files onto
+    it outside of Blender (see bvh.py).
+    """
+    names, parent_indices, rest = get_skeleton(rig)
+    np.savez(path, names=np.array(names), parent_indices=parent_indices, rest=rest)
+
+def retarget_bvh(filepath, trg_rig, insert_restframes=False, in_place=False, chunk_size=RETARGET_CHUNK_SIZE, progress=None, reduce_tolerance=None, global_scale=1.0):
+    """Retarget a BVH file onto trg_rig without importing it as an armature.
+    The motion is read straight from the file and fed to the batched solver,
+    giving the same result as importing the BVH with the Blender BVH importer
+    (at frame 1) and retargeting the imported armature. See
+    retarget_animation() for the other arguments.
+    """
+    names, parent_indices, rest = get_skeleton(trg_rig)
+    r = bvh.BvhRetarget(bvh.BvhFile(filepath), names, parent_indices, rest, global_scale)
+    for src_name, trg_name in r.mapping:
+        print ("Bone mapped: %s -> %s" % (src_name, trg_name))
+    pose_bones = [trg_rig.pose.bones[trg_idx] for trg_idx in r.trg_indices]
+
+    n_frames = r.bvh.n_frames
+    channels = None
+    for first_frame, pose_mats in r.iter_solve(chunk_size):
+        chunk_channels = pose_bone_channels(pose_bones, pose_mats, in_place)
+        if channels is None:
+            channels = [(pose_bone, prop, [values]) for pose_bone, prop, values in chunk_channels]
+        else:
+            for channel, (_, _, values) in zip(channels, chunk_channels):
+                channel[2].append(values)
+        if progress:
+            progress(first_frame + len(pose_mats), n_frames)
+        else:
+            print ("Retargetting frame %s/%s" % (first_frame + len(pose_mats), n_frames))
+    if channels is None:
+        return
+    channels = [(pose_bone, prop, np.concatenate(values)) for pose_bone, prop, values in channels]
+
+    # The Blender BVH importer keys the first frame of the file on frame 1
+    target_frames, rest_frames = get_target_frames(range(1, len(channels[0][2])+1), insert_restframes)
+    write_channels(trg_rig, channels, target_frames, rest_frames)
+    if reduce_tolerance:
+        reduce_keyframes(trg_rig.animation_data.action, reduce_tolerance)
 
 
 def main():
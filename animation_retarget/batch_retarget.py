@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman/
+
+**Author:**            Jonas Hauquier, Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2015
+
+**Licensing:**         AGPL3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Abstract
+--------
+
+Retarget a library of BVH files onto a MH (or other) skeleton without user
+interaction.
+
+Every BVH clip is imported in a background Blender process that has the target
+rig .blend loaded, retargeted onto the target armature, and the resulting action
+is saved to a .blend library or exported as BVH. Clips are divided over a number
+of Blender processes that run in parallel.
+Progress is stored in a manifest file in the output folder, so an interrupted
+batch continues where it stopped when run again. Timing and failures are
+reported per clip.
+
+Usage:
+    python batch_retarget.py --blender <blender> --target <rig.blend> --rig <armature name>
+                             --output <output folder> [--jobs N] <bvh folder>
+"""
+
+import sys
+import os
+import time
+import json
+import argparse
+import subprocess
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append( os.path.dirname(os.path.abspath(__file__)) )
+
+MANIFEST_NAME = 'retarget_manifest.json'
+CLIPS_PER_JOB = 20  # Number of clips retargeted by one Blender process
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def find_bvh_files(folder):
+    """List all .bvh files in folder and its subfolders, relative to folder.
+    """
+    clips = []
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() == '.bvh':
+                clips.append(os.path.relpath(os.path.join(root, filename), folder))
+    return sorted(clips)
+
+def clip_name(clip):
+    """Action name for a clip, from its path relative to the BVH folder.
+    """
+    return os.path.splitext(clip)[0].replace(os.sep, '_')
+
+
+#
+#   Worker, runs inside Blender
+#
+
+def _remove_object(scn, obj):
+    import bpy
+    data = obj.data
+    action = obj.animation_data.action if obj.animation_data else None
+    try:
+        bpy.data.objects.remove(obj, do_unlink=True)
+    except TypeError:
+        scn.objects.unlink(obj)
+        bpy.data.objects.remove(obj)
+    if data and data.users == 0:
+        bpy.data.armatures.remove(data)
+    if action and action.users == 0:
+        bpy.data.actions.remove(action)
+
+def _save_action(scn, trg_rig, action, path, export_format):
+    import bpy
+    if export_format == 'bvh':
+        frame_start, frame_end = action.frame_range
+        scn.objects.active = trg_rig
+        bpy.ops.export_anim.bvh(filepath=path, frame_start=int(frame_start), frame_end=int(frame_end))
+    else:
+        bpy.data.libraries.write(path, set([action]), fake_user=True)
+
+def retarget_clips(rig_name, bvh_dir, clips, output_dir, results_path, export_format='blend', insert_restframes=False, in_place=False, reduce_tolerance=None, direct=False):
+    """Retarget BVH clips onto the armature object rig_name of the currently
+    loaded .blend file. Results are written to results_path as JSON after
+    every clip.
+    With direct == True the BVH files are read directly instead of being
+    imported as armature first.
+    """
+    import bpy
+    import animation_retarget_mh
+
+    scn = bpy.context.scene
+    trg_rig = bpy.data.objects[rig_name]
+    results = {}
+    for clip in clips:
+        start = time.time()
+        src_rig = None
+        result = results[clip] = {}
+        try:
+            if bpy.context.object and bpy.context.object.mode != 'OBJECT':
+                bpy.ops.object.mode_set(mode='OBJECT')
+            if trg_rig.animation_data:
+                trg_rig.animation_data.action = None
+            if direct:
+                animation_retarget_mh.retarget_bvh(os.path.join(bvh_dir, clip), trg_rig, insert_restframes, in_place, progress=lambda done, total: None, reduce_tolerance=reduce_tolerance)
+            else:
+                bpy.ops.import_anim.bvh(filepath=os.path.join(bvh_dir, clip))
+                src_rig = bpy.context.object
+                animation_retarget_mh.retarget_animation(src_rig, trg_rig, insert_restframes, in_place, progress=lambda done, total: None, reduce_tolerance=reduce_tolerance)
+
+            action = trg_rig.animation_data.action
+            action.name = clip_name(clip)
+            output = os.path.join(output_dir, clip_name(clip) + ('.bvh' if export_format == 'bvh' else '.blend'))
+            bpy.ops.object.mode_set(mode='OBJECT')
+            _save_action(scn, trg_rig, action, output, export_format)
+
+            trg_rig.animation_data.action = None
+            bpy.data.actions.remove(action)
+            result['status'] = STATUS_DONE
+            result['output'] = output
+        except Exception as e:
+            traceback.print_exc()
+            result['status'] = STATUS_FAILED
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+        finally:
+            if src_rig:
+                if bpy.context.object and bpy.context.object.mode != 'OBJECT':
+                    bpy.ops.object.mode_set(mode='OBJECT')
+                _remove_object(scn, src_rig)
+        result['time'] = time.time() - start
+        print ("%s %s (%.2fs)" % (clip, result['status'], result['time']))
+
+        with open(results_path, 'w') as f:
+            json.dump(results, f)
+
+
+#
+#   Driver, runs the Blender workers
+#
+
+def load_manifest(path):
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {'clips': {}}
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _run_worker(args, clips):
+    """Retarget clips in a background Blender process. Returns a dict with the
+    result per clip.
+    """
+    fd, results_path = tempfile.mkstemp(suffix='.json', prefix='retarget_')
+    os.close(fd)
+    cmd = [args.blender, '--background', args.target, '--python', os.path.abspath(__file__), '--',
+           '--worker', '--rig', args.rig, '--output', args.output, '--format', args.format,
+           '--results', results_path, args.bvh_dir]
+    if args.insert_rests:
+        cmd.append('--insert-rests')
+    if args.in_place:
+        cmd.append('--in-place')
+    if args.reduce:
+        cmd.append('--reduce=%s' % args.reduce)
+    if args.direct:
+        cmd.append('--direct')
+    cmd += ['--clip=%s' % clip for clip in clips]
+
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(cmd, stdout=devnull if not args.verbose else None)
+    try:
+        with open(results_path, 'r') as f:
+            results = json.load(f)
+    except ValueError:
+        results = {}
+    os.remove(results_path)
+
+    # Clips the worker did not get to, eg. because Blender crashed
+    for clip in clips:
+        if clip not in results:
+            results[clip] = {'status': STATUS_FAILED, 'time': time.time() - start,
+                             'error': "Blender exited with code %s" % returncode}
+    return results
+
+def run_batch(args):
+    """Retarget all BVH files in args.bvh_dir that are not done yet according
+    to the manifest.
+    """
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    manifest_path = args.manifest or os.path.join(args.output, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    clips = find_bvh_files(args.bvh_dir)
+    pending = [clip for clip in clips if manifest['clips'].get(clip, {}).get('status') != STATUS_DONE]
+    if not args.retry_failed:
+        pending = [clip for clip in pending if manifest['clips'].get(clip, {}).get('status') != STATUS_FAILED]
+    print ("%s clips, %s to retarget with %s Blender processes" % (len(clips), len(pending), args.jobs))
+
+    chunks = [pending[i:i+args.clips_per_job] for i in range(0, len(pending), args.clips_per_job)]
+    start = time.time()
+    done = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(_run_worker, args, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            results = future.result()
+            manifest['clips'].update(results)
+            save_manifest(manifest, manifest_path)
+            done += len(results)
+            print ("Retargeted %s/%s clips (%.1fs)" % (done, len(pending), time.time() - start))
+
+    report(manifest, clips)
+
+def report(manifest, clips):
+    """Print timing and failures of all clips in the manifest.
+    """
+    results = [(clip, manifest['clips'][clip]) for clip in clips if clip in manifest['clips']]
+    done = [(clip, r) for clip, r in results if r['status'] == STATUS_DONE]
+    failed = [(clip, r) for clip, r in results if r['status'] == STATUS_FAILED]
+
+    print ("\nClip timings:")
+    for clip, r in results:
+        print ("  %-50s %-7s %8.2fs" % (clip, r['status'], r.get('time', 0)))
+    if done:
+        total = sum(r.get('time', 0) for _, r in done)
+        print ("%s clips done, %.2fs per clip on average" % (len(done), total / len(done)))
+    if failed:
+        print ("%s clips failed:" % len(failed))
+        for clip, r in failed:
+            print ("  %s: %s" % (clip, r.get('error')))
+    missing = len(clips) - len(results)
+    if missing:
+        print ("%s clips not retargeted yet" % missing)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Retarget a folder of BVH files onto a target rig using background Blender processes.")
+    parser.add_argument('bvh_dir', help="Folder with BVH files (searched recursively)")
+    parser.add_argument('--rig', required=True, help="Name of the target armature object in the .blend file")
+    parser.add_argument('--output', required=True, help="Output folder")
+    parser.add_argument('--format', choices=['blend', 'bvh'], default='blend', help="Save each action as .blend library or export it as BVH")
+    parser.add_argument('--insert-rests', action='store_true', help="Insert a rest frame between every two frames")
+    parser.add_argument('--in-place', action='store_true', help="Keep animation in-place and ignore translations")
+    parser.add_argument('--reduce', type=float, metavar='TOLERANCE', help="Remove redundant keyframes within this tolerance")
+    parser.add_argument('--direct', action='store_true', help="Read BVH files directly instead of importing them as armature")
+    # Driver options
+    parser.add_argument('--blender', default='blender', help="Blender executable")
+    parser.add_argument('--target', help="Target rig .blend file")
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 2) - 1), help="Number of Blender processes to run in parallel")
+    parser.add_argument('--clips-per-job', type=int, default=CLIPS_PER_JOB, help="Number of clips to retarget per Blender process")
+    parser.add_argument('--manifest', help="Manifest file (default: %s in the output folder)" % MANIFEST_NAME)
+    parser.add_argument('--retry-failed', action='store_true', help="Also retarget clips that failed before")
+    parser.add_argument('--verbose', action='store_true', help="Show Blender output")
+    # Worker options
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--results', help=argparse.SUPPRESS)
+    parser.add_argument('--clip', action='append', default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if not args.worker and not args.target:
+        parser.error("--target is required")
+    return args
+
+def main():
+    # Blender passes the script arguments after --
+    argv = sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else sys.argv[1:]
+    args = parse_args(argv)
+    if args.worker:
+        retarget_clips(args.rig, args.bvh_dir, args.clip, args.output, args.results, args.format, args.insert_rests, args.in_place, args.reduce, args.direct)
+    else:
+        run_batch(args)
+
+if __name__ == '__main__':
+    main()
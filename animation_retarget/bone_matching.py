@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman/
+
+**Author:**            Jonas Hauquier, Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2015
+
+**Licensing:**         AGPL3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Abstract
+--------
+
+Match bone names of a source skeleton to those of a target skeleton.
+
+Bone names are normalized (case, separators and left/right markers) so that
+names like "LeftUpLeg", "upleg_L" and "UpLeg.L" compare equal. Exact matches
+are resolved through a dict index, the remaining target bones are compared
+with fuzzy string matching against a small set of candidates found through a
+trigram index.
+The resulting mapping is cached on disk per pair of skeletons, so batch jobs
+only match names once per rig pair.
+This module does not depend on Blender.
+"""
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+from collections import Counter
+from difflib import SequenceMatcher
+
+BONE_NAME_SIMILARITY_THRESHOLD = 0.7
+MAX_FUZZY_CANDIDATES = 8    # Number of trigram candidates to compare with fuzzy matching
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'makehuman', 'retarget')
+CACHE_VERSION = 1   # Increase when the matching algorithm changes
+
+_SIDES = {
+    'l': 'l', 'left': 'l',
+    'r': 'r', 'right': 'r',
+}
+
+_TOKEN_SPLIT = re.compile(r'[\s_.\-:|]+')
+_CAMEL_SPLIT = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+
+def fuzzy_stringmatch_ratio(str1, str2):
+    """Compare two strings using a fuzzy matching algorithm. Returns the
+    similarity of both strings as a float, with 1 meaning identical match,
+    and 0 meaning no similarity at all.
+    """
+    m = SequenceMatcher(None, str1, str2)
+    return m.ratio()
+
+def normalize_bone_name(name):
+    """Normalize a bone name for comparison. Returns a (name, side) tuple with
+    a lowercase name without separators or namespace prefix, and side one of
+    'l', 'r' or '' for bones without side.
+    Eg. "mixamorig:LeftUpLeg", "upleg_L" and "UpLeg.L" all normalize to
+    ("upleg", "l").
+    """
+    name = name.rsplit(':', 1)[-1]
+    tokens = []
+    for part in _TOKEN_SPLIT.split(name):
+        tokens.extend(_CAMEL_SPLIT.split(part))
+    tokens = [t.lower() for t in tokens if t]
+
+    side = ''
+    if len(tokens) > 1 and tokens[-1] in _SIDES:
+        side = _SIDES[tokens.pop()]
+    elif len(tokens) > 1 and tokens[0] in _SIDES:
+        side = _SIDES[tokens.pop(0)]
+    return (''.join(tokens), side)
+
+def _trigrams(string):
+    string = '  %s ' % string
+    return set(string[i:i+3] for i in range(len(string)-2))
+
+def names_signature(names):
+    """Signature of a skeleton, based on its bone names, to identify it in the
+    mapping cache.
+    """
+    return hashlib.sha1('\n'.join(names).encode('utf-8')).hexdigest()
+
+
+class BoneNameMatcher(object):
+    """Index of source bone names, to find the best matching source bone for a
+    target bone name.
+    """
+    def __init__(self, src_names, threshold=BONE_NAME_SIMILARITY_THRESHOLD):
+        self.src_names = list(src_names)
+        self.src_set = set(self.src_names)
+        self.threshold = threshold
+
+        self.exact_lookup = {}       # Normalized (name, side) -> source names
+        self.trigram_lookup = {}     # (trigram, side) -> source names
+        for src_name in self.src_names:
+            key = normalize_bone_name(src_name)
+            self.exact_lookup.setdefault(key, []).append(src_name)
+            for trigram in _trigrams(key[0]):
+                self.trigram_lookup.setdefault((trigram, key[1]), []).append(src_name)
+
+    def match(self, trg_name, exclude=()):
+        """Find the source bone best matching the target bone name. Source
+        bones in exclude are skipped. Returns a (src_name, score) tuple, or
+        (None, score) if no source bone is similar enough.
+        """
+        if trg_name in self.src_set and trg_name not in exclude:
+            return (trg_name, 1.0)
+
+        key = normalize_bone_name(trg_name)
+        for src_name in self.exact_lookup.get(key, []):
+            if src_name not in exclude:
+                return (src_name, 1.0)
+
+        # Narrow the fuzzy candidates down to the bones on the same side
+        # sharing the most trigrams
+        shared = Counter()
+        for trigram in _trigrams(key[0]):
+            shared.update(self.trigram_lookup.get((trigram, key[1]), []))
+        candidates = [src_name for src_name, _ in shared.most_common() if src_name not in exclude]
+
+        best_candidate = None
+        score = -1
+        for src_name in candidates[:MAX_FUZZY_CANDIDATES]:
+            ratio = fuzzy_stringmatch_ratio(src_name, trg_name)
+            if ratio > score:
+                score = ratio
+                best_candidate = src_name
+        if best_candidate is not None and score > self.threshold:
+            return (best_candidate, score)
+        return (None, score)
+
+    def find_mapping(self, trg_names):
+        """Map target bone names to source bone names. Returns a list of
+        (src_name, trg_name) tuples, in order of trg_names. Target bones with
+        an identically named source bone are mapped first, every source bone
+        is mapped at most once.
+        """
+        mapping = {}
+        used = set()
+        for trg_name in trg_names:
+            if trg_name in self.src_set:
+                mapping[trg_name] = trg_name
+                used.add(trg_name)
+
+        for trg_name in trg_names:
+            if trg_name in mapping:
+                continue
+            src_name, _ = self.match(trg_name, used)
+            if src_name is not None:
+                mapping[trg_name] = src_name
+                used.add(src_name)
+
+        return [(mapping[trg_name], trg_name) for trg_name in trg_names if trg_name in mapping]
+
+
+def _cache_path(src_names, trg_names, threshold, cache_dir):
+    key = '%s_%s_%s_%s' % (names_signature(src_names), names_signature(trg_names), threshold, CACHE_VERSION)
+    return os.path.join(cache_dir, 'bonemap_%s.json' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def find_bone_mapping(src_names, trg_names, threshold=BONE_NAME_SIMILARITY_THRESHOLD, cache_dir=CACHE_DIR):
+    """Map target bone names to source bone names, see
+    BoneNameMatcher.find_mapping(). The result is cached in cache_dir per
+    combination of source and target skeleton, set cache_dir to None to
+    disable caching.
+    """
+    src_names = list(src_names)
+    trg_names = list(trg_names)
+
+    if cache_dir:
+        path = _cache_path(src_names, trg_names, threshold, cache_dir)
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    return [tuple(pair) for pair in json.load(f)]
+            except (IOError, ValueError):
+                print ("Ignoring invalid bone mapping cache %s" % path)
+
+    mapping = BoneNameMatcher(src_names, threshold).find_mapping(trg_names)
+
+    if cache_dir:
+        # Written under a temporary name and then renamed, so that concurrent
+        # imports never read a partly written file
+        tmp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.json', prefix='bonemap_', dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(mapping, f)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            print ("Could not write bone mapping cache %s" % path)
+            if tmp_path and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+    return mapping
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman/
+
+**Author:**            Jonas Hauquier, Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2015
+
+**Licensing:**         AGPL3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Abstract
+--------
+
+Read BVH motion capture files directly into NumPy arrays, and retarget them
+onto a target skeleton without importing them in Blender.
+
+The HIERARCHY block is parsed into joint names, parents, offsets and channels.
+The MOTION block is read through a memory map in chunks of frames, so large
+files are never loaded completely. Joint matrices are calculated the same way
+as for a BVH imported with the Blender BVH importer: in the space of the BVH
+file, relative to the armature, with the joint head as translation.
+
+This module does not depend on Blender. To retarget BVH files in a plain
+Python process, export the target skeleton from Blender first with
+animation_retarget_mh.save_skeleton(), then run:
+    python bvh.py <skeleton.npz> <output folder> <bvh files>
+which writes the target pose of every clip to an .npz file with per-bone
+quaternions and locations.
+"""
+
+import os
+import sys
+import mmap
+import numpy as np
+
+sys.path.append( os.path.dirname(os.path.abspath(__file__)) )
+
+import bone_matching
+import pose_math
+
+BVH_CHUNK_SIZE = 1000   # Number of frames to parse at once
+
+_POSITION_CHANNELS = ('Xposition', 'Yposition', 'Zposition')
+_ROTATION_CHANNELS = ('Xrotation', 'Yrotation', 'Zrotation')
+
+
+class BvhError(Exception):
+    pass
+
+
+class BvhFile(object):
+    """The skeleton and motion of a BVH file.
+    Joints are stored in file order, which always lists parents before their
+    children. End sites are not joints.
+        names           joint names
+        parent_indices  index of the parent joint, -1 for the root
+        offsets         (J, 3) joint offsets relative to the parent
+        channels        channel names of every joint
+        channel_starts  index of the first channel of every joint in a frame
+    """
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.parent_indices = []
+        self.offsets = []
+        self.channels = []
+        self.channel_starts = []
+        self.n_channels = 0
+        self.n_frames = 0
+        self.frame_time = 0.0
+        self._motion_offset = 0
+
+        with open(path, 'rb') as f:
+            self._read_hierarchy(f)
+        self.parent_indices = np.array(self.parent_indices, dtype=np.int32)
+        self.offsets = np.array(self.offsets, dtype=np.float64).reshape(-1, 3)
+
+    def _read_hierarchy(self, f):
+        stack = []
+        in_end_site = False
+        for line in iter(f.readline, b''):
+            tokens = line.decode('utf-8', 'replace').split()
+            if not tokens:
+                continue
+            keyword = tokens[0]
+            if keyword in ('ROOT', 'JOINT'):
+                self.names.append(' '.join(tokens[1:]))
+                self.parent_indices.append(stack[-1] if stack else -1)
+                self.offsets.append((0.0, 0.0, 0.0))
+                self.channels.append(())
+                self.channel_starts.append(self.n_channels)
+                stack.append(len(self.names) - 1)
+            elif keyword == 'End':
+                in_end_site = True
+            elif keyword == 'OFFSET' and not in_end_site:
+                self.offsets[stack[-1]] = tuple(float(v) for v in tokens[1:4])
+            elif keyword == 'CHANNELS':
+                self.channels[stack[-1]] = tuple(tokens[2:2+int(tokens[1])])
+                self.channel_starts[stack[-1]] = self.n_channels
+                self.n_channels += int(tokens[1])
+            elif keyword == '}':
+                if in_end_site:
+                    in_end_site = False
+                else:
+                    stack.pop()
+            elif keyword == 'Frames:':
+                self.n_frames = int(tokens[1])
+            elif keyword == 'Frame' and tokens[1] == 'Time:':
+                self.frame_time = float(tokens[2])
+                self._motion_offset = f.tell()
+                break
+        if not self.names or not self._motion_offset:
+            raise BvhError("%s is not a valid BVH file" % self.path)
+
+    def iter_motion(self, chunk_size=BVH_CHUNK_SIZE):
+        """Iterate over the motion data in chunks of at most chunk_size frames.
+        Yields (first_frame, channels) tuples, with channels an (F, C) float64
+        array holding the channel values of F frames. The file is read through
+        a memory map.
+        """
+        n_channels = self.n_channels
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= self._motion_offset:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = self._motion_offset
+                first_frame = 0
+                # Read blocks of about chunk_size frame lines, sized after the
+                # first line, and parse all values of a block at once
+                line_end = mm.find(b'\n', pos)
+                line_size = (len(mm) if line_end == -1 else line_end) - pos + 1
+                block_size = max(line_size, 2 * n_channels) * chunk_size
+                pending = np.zeros((0, n_channels), dtype=np.float64)
+                while first_frame < self.n_frames:
+                    if len(pending) < chunk_size and pos < len(mm):
+                        # Extend the block to the end of its last line
+                        end = mm.find(b'\n', min(pos + block_size, len(mm)))
+                        end = len(mm) if end == -1 else end + 1
+                        try:
+                            values = np.array(mm[pos:end].split(), dtype=np.float64)
+                        except ValueError:
+                            raise BvhError("Invalid motion data in %s after frame %s" % (self.path, first_frame + len(pending)))
+                        pos = end
+                        if len(values) % n_channels:
+                            raise BvhError("Motion data of %s does not match the hierarchy after frame %s" % (self.path, first_frame + len(pending)))
+                        pending = np.concatenate((pending, values.reshape(-1, n_channels)))
+                        continue
+                    if not len(pending):
+                        break
+                    values = pending[:min(chunk_size, self.n_frames - first_frame)]
+                    pending = pending[len(values):]
+                    yield first_frame, values
+                    first_frame += len(values)
+            finally:
+                mm.close()
+
+    def read_motion(self):
+        """Read all motion data as one (F, C) array.
+        """
+        chunks = [values for _, values in self.iter_motion()]
+        if not chunks:
+            return np.zeros((0, self.n_channels), dtype=np.float64)
+        return np.concatenate(chunks)
+
+    def rest_matrices(self, global_scale=1.0):
+        """Joint matrices relative to the armature in rest pose, as a (J, 4, 4)
+        array.
+        """
+        local = np.tile(np.identity(4), (1, len(self.names), 1, 1))
+        local[0, :, :3, 3] = self.offsets * global_scale
+        return pose_math.global_matrices(local, np.tile(np.identity(4), (len(self.names), 1, 1)), self.parent_indices)[0]
+
+    def joint_matrices(self, values, global_scale=1.0):
+        """Calculate the (F, J, 4, 4) joint matrices, relative to the armature,
+        from an (F, C) array of channel values. Position channels replace the
+        joint offset, like in the Blender BVH importer.
+        """
+        n_frames = len(values)
+        n_joints = len(self.names)
+        eulers = np.zeros((n_frames, n_joints, 3), dtype=np.float64)
+        local = np.tile(np.identity(4), (n_frames, n_joints, 1, 1))
+        local[:, :, :3, 3] = self.offsets * global_scale
+
+        orders = {}
+        for j_idx, channels in enumerate(self.channels):
+            start = self.channel_starts[j_idx]
+            order = ''
+            for c_idx, channel in enumerate(channels):
+                if channel in _ROTATION_CHANNELS:
+                    eulers[:, j_idx, _ROTATION_CHANNELS.index(channel)] = values[:, start + c_idx]
+                    order += channel[0]
+                elif channel in _POSITION_CHANNELS:
+                    local[:, j_idx, _POSITION_CHANNELS.index(channel), 3] = values[:, start + c_idx] * global_scale
+            if len(order) == 3:
+                # Channels are listed outermost rotation first, which is the
+                # reverse of Blender's euler order
+                orders.setdefault(order[::-1], []).append(j_idx)
+            elif order:
+                # Missing rotation axes do not change the result
+                order += ''.join(axis for axis in 'XYZ' if axis not in order)
+                orders.setdefault(order[::-1], []).append(j_idx)
+
+        eulers = np.radians(eulers)
+        for order, j_indices in orders.items():
+            local[:, j_indices, :3, :3] = pose_math.eulers_to_matrices(eulers[:, j_indices], order)
+        return pose_math.global_matrices(local, np.tile(np.identity(4), (n_joints, 1, 1)), self.parent_indices)
+
+
+class BvhRetarget(object):
+    """Retarget a BVH file onto a target skeleton, described by its bone names,
+    parent indices and (B, 4, 4) rest matrices (Bone.matrix_local), without
+    Blender.
+    Bones are matched by name like in AnimationRetarget. Mappings are sorted by
+    depth of the target bone; for target bones whose parent is not mapped the
+    nearest mapped ancestor is used, assuming the bones in between stay in
+    rest pose.
+    """
+    def __init__(self, bvh, trg_names, trg_parents, trg_rest, global_scale=1.0, cache_dir=bone_matching.CACHE_DIR):
+        self.bvh = bvh
+        self.global_scale = global_scale
+        trg_names = list(trg_names)
+        trg_parents = np.asarray(trg_parents)
+
+        mapping = bone_matching.find_bone_mapping(bvh.names, trg_names, bone_matching.BONE_NAME_SIMILARITY_THRESHOLD, cache_dir)
+        src_lookup = dict((name, idx) for idx, name in enumerate(bvh.names))
+        trg_lookup = dict((name, idx) for idx, name in enumerate(trg_names))
+        depth_order = list(pose_math.depth_order(trg_parents))
+        mapping.sort(key=lambda pair: depth_order.index(trg_lookup[pair[1]]))
+
+        self.mapping = mapping
+        self.src_indices = np.array([src_lookup[src_name] for src_name, _ in mapping], dtype=np.int32)
+        self.trg_indices = np.array([trg_lookup[trg_name] for _, trg_name in mapping], dtype=np.int32)
+
+        map_indices = dict((trg_idx, idx) for idx, trg_idx in enumerate(self.trg_indices))
+        parent_indices = []
+        ancestors = []
+        for trg_idx in self.trg_indices:
+            p_idx = trg_parents[trg_idx]
+            while p_idx >= 0 and p_idx not in map_indices:
+                p_idx = trg_parents[p_idx]
+            parent_indices.append(map_indices[p_idx] if p_idx >= 0 else -1)
+            ancestors.append(p_idx)
+        self.parent_indices = np.array(parent_indices, dtype=np.int32)
+
+        # B_b = R_b^-1 R_p, A_b = M_src^-1 M_trg in rest pose
+        self.b_mats = pose_math.invert(trg_rest[self.trg_indices])
+        has_parent = self.parent_indices >= 0
+        self.b_mats[has_parent] = pose_math.matmul(self.b_mats[has_parent], trg_rest[np.array(ancestors)[has_parent]])
+        src_rest = bvh.rest_matrices(global_scale)[self.src_indices]
+        self.a_mats = pose_math.rest_compensation_matrices(src_rest, trg_rest[self.trg_indices])
+
+    def iter_solve(self, chunk_size=BVH_CHUNK_SIZE):
+        """Retarget the BVH motion in chunks of frames. Yields (first_frame,
+        pose_mats) tuples, with pose_mats the (F, B, 4, 4) local target pose
+        matrices (L_b) of the mapped bones, in mapping order.
+        """
+        for first_frame, values in self.bvh.iter_motion(chunk_size):
+            src_mats = self.bvh.joint_matrices(values, self.global_scale)[:, self.src_indices]
+            yield first_frame, pose_math.retarget_matrices(src_mats, self.a_mats, self.b_mats, self.parent_indices)
+
+    def solve(self, chunk_size=BVH_CHUNK_SIZE):
+        """Retarget all frames, returns an (F, B, 4, 4) array of target pose
+        matrices.
+        """
+        chunks = [pose_mats for _, pose_mats in self.iter_solve(chunk_size)]
+        if not chunks:
+            return np.zeros((0, len(self.mapping), 4, 4), dtype=np.float64)
+        return np.concatenate(chunks)
+
+
+def load_skeleton(path):
+    """Load a target skeleton saved with animation_retarget_mh.save_skeleton().
+    Returns a (names, parent_indices, rest) tuple.
+    """
+    with np.load(path) as data:
+        return ([str(name) for name in data['names']], data['parent_indices'], data['rest'])
+
+def retarget_file(bvh_path, skeleton, output_path, global_scale=1.0, chunk_size=BVH_CHUNK_SIZE):
+    """Retarget a BVH file onto a (names, parent_indices, rest) skeleton and
+    save the result to output_path as .npz file with the mapped target bone
+    names, and their (F, B, 4) quaternions and (F, B, 3) locations.
+    """
+    names, parent_indices, rest = skeleton
+    retarget = BvhRetarget(BvhFile(bvh_path), names, parent_indices, rest, global_scale)
+    quats = []
+    locs = []
+    for _, pose_mats in retarget.iter_solve(chunk_size):
+        quats.append(pose_math.matrices_to_quaternions(pose_mats).astype(np.float32))
+        locs.append(pose_mats[:, :, :3, 3].astype(np.float32))
+    np.savez(output_path,
+             names = np.array([trg_name for _, trg_name in retarget.mapping]),
+             quaternions = np.concatenate(quats) if quats else np.zeros((0, len(retarget.mapping), 4), dtype=np.float32),
+             locations = np.concatenate(locs) if locs else np.zeros((0, len(retarget.mapping), 3), dtype=np.float32),
+             frame_time = retarget.bvh.frame_time)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Retarget BVH files onto a skeleton saved from Blender, without Blender.")
+    parser.add_argument('skeleton', help="Target skeleton .npz file, see animation_retarget_mh.save_skeleton()")
+    parser.add_argument('output', help="Output folder")
+    parser.add_argument('bvh_files', nargs='+', help="BVH files to retarget")
+    parser.add_argument('--scale', type=float, default=1.0, help="Scale applied to the BVH positions")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    skeleton = load_skeleton(args.skeleton)
+    for bvh_path in args.bvh_files:
+        output_path = os.path.join(args.output, os.path.splitext(os.path.basename(bvh_path))[0] + '.npz')
+        retarget_file(bvh_path, skeleton, output_path, args.scale)
+        print ("%s -> %s" % (bvh_path, output_path))
+
+if __name__ == '__main__':
+    main()
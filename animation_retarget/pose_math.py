@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman/
+
+**Author:**            Jonas Hauquier, Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2015
+
+**Licensing:**         AGPL3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Abstract
+--------
+
+Batched pose math for animation retargeting, using NumPy only.
+
+All functions work on stacks of matrices, typically (F, B, 4, 4) arrays for F
+frames of B bones, and do not depend on Blender, so the retarget equations can
+be benchmarked and verified outside of it.
+
+Bones are described by parent index arrays, with -1 for root bones. Matrices
+follow the conventions of animation_retarget_mh:
+
+    M_b = global bone matrix, relative armature (PoseBone.matrix)
+    L_b = local bone matrix, relative parent and rest (PoseBone.matrix_basis)
+    R_b = bone rest matrix, relative armature (Bone.matrix_local)
+
+    M_b = M_p R_p^-1 R_b L_b
+    A_b = M_src^-1 M_trg, in rest pose
+    B_b = R^-1_b R_p
+    L_b = B_b M^-1_p A_b M'_b
+
+Run this file to benchmark the retarget equations on synthetic skeletons:
+    python pose_math.py
+They are verified against a per-bone implementation in tests/test_pose_math.py.
+"""
+
+import time
+import numpy as np
+
+
+def matmul(a, b):
+    """Matrix product of two stacks of matrices, broadcast over the leading
+    axes.
+    """
+    return np.einsum('...ij,...jk->...ik', a, b)
+
+def invert(mats):
+    """Inverse of a stack of matrices.
+    """
+    return np.linalg.inv(mats)
+
+def matrices_to_quaternions(mats):
+    """Convert a stack of (..., 4, 4) or (..., 3, 3) matrices to (..., 4)
+    quaternions in (w, x, y, z) order. Scale is removed from the rotation part
+    first, like Matrix.to_quaternion() does.
+    """
+    rot = mats[..., :3, :3]
+    rot = rot / np.linalg.norm(rot, axis=-2)[..., np.newaxis, :]
+    m00, m01, m02 = rot[..., 0, 0], rot[..., 0, 1], rot[..., 0, 2]
+    m10, m11, m12 = rot[..., 1, 0], rot[..., 1, 1], rot[..., 1, 2]
+    m20, m21, m22 = rot[..., 2, 0], rot[..., 2, 1], rot[..., 2, 2]
+
+    # Solve for each of the four components, and pick the best conditioned one
+    # per matrix
+    cands = np.stack([
+        np.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], axis=-1),
+        np.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], axis=-1),
+        np.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], axis=-1),
+        np.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], axis=-1),
+        ], axis=-2)
+    diag = np.stack([1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22], axis=-1)
+    best = np.argmax(diag, axis=-1).ravel()
+    quats = cands.reshape(-1, 4, 4)[np.arange(len(best)), best].reshape(diag.shape)
+    quats /= np.linalg.norm(quats, axis=-1)[..., np.newaxis]
+    # Prefer a positive w, like mathutils
+    quats *= np.where(quats[..., :1] < 0, -1.0, 1.0)
+    return quats
+
+def matrices_to_eulers(mats, order='XYZ'):
+    """Convert a stack of (..., 4, 4) or (..., 3, 3) matrices to (..., 3) euler
+    angles with the specified Blender rotation order.
+    """
+    i, j, k = ['XYZ'.index(axis) for axis in order]
+    # Odd permutations of the axes flip the sign of the off-diagonal terms
+    sign = 1.0 if order in ('XYZ', 'YZX', 'ZXY') else -1.0
+
+    rot = mats[..., :3, :3]
+    rot = rot / np.linalg.norm(rot, axis=-2)[..., np.newaxis, :]
+    cos_b = np.hypot(rot[..., i, i], rot[..., j, i])
+    gimbal = cos_b < 1e-6
+
+    eulers = np.empty(rot.shape[:-2] + (3,), dtype=rot.dtype)
+    eulers[..., i] = np.where(gimbal,
+                              np.arctan2(-sign * rot[..., j, k], rot[..., j, j]),
+                              np.arctan2(sign * rot[..., k, j], rot[..., k, k]))
+    eulers[..., j] = np.arctan2(-sign * rot[..., k, i], cos_b)
+    eulers[..., k] = np.where(gimbal, 0.0, np.arctan2(sign * rot[..., j, i], rot[..., i, i]))
+    return eulers
+
+def _axis_matrices(axis, angles):
+    """Rotation matrices around the X (0), Y (1) or Z (2) axis for an array of
+    angles.
+    """
+    cos, sin = np.cos(angles), np.sin(angles)
+    j, k = (axis + 1) % 3, (axis + 2) % 3
+    mats = np.zeros(np.shape(angles) + (3, 3), dtype=np.float64)
+    mats[..., axis, axis] = 1.0
+    mats[..., j, j] = cos
+    mats[..., k, k] = cos
+    mats[..., j, k] = -sin
+    mats[..., k, j] = sin
+    return mats
+
+def quaternions_to_matrices(quats):
+    """Convert (..., 4) quaternions in (w, x, y, z) order to (..., 3, 3)
+    rotation matrices. Quaternions are normalized first, like Blender does when
+    evaluating a pose.
+    """
+    quats = quats / np.linalg.norm(quats, axis=-1)[..., np.newaxis]
+    w, x, y, z = quats[..., 0], quats[..., 1], quats[..., 2], quats[..., 3]
+    mats = np.empty(quats.shape[:-1] + (3, 3), dtype=np.float64)
+    mats[..., 0, 0] = 1 - 2*(y*y + z*z)
+    mats[..., 0, 1] = 2*(x*y - w*z)
+    mats[..., 0, 2] = 2*(x*z + w*y)
+    mats[..., 1, 0] = 2*(x*y + w*z)
+    mats[..., 1, 1] = 1 - 2*(x*x + z*z)
+    mats[..., 1, 2] = 2*(y*z - w*x)
+    mats[..., 2, 0] = 2*(x*z - w*y)
+    mats[..., 2, 1] = 2*(y*z + w*x)
+    mats[..., 2, 2] = 1 - 2*(x*x + y*y)
+    return mats
+
+def axis_angles_to_matrices(axis_angles):
+    """Convert (..., 4) rotations in (angle, x, y, z) order to (..., 3, 3)
+    rotation matrices.
+    """
+    half = axis_angles[..., 0] / 2
+    axes = axis_angles[..., 1:]
+    length = np.linalg.norm(axes, axis=-1)[..., np.newaxis]
+    axes = np.where(length > 1e-8, axes / np.maximum(length, 1e-8), (0.0, 1.0, 0.0))
+    quats = np.concatenate([np.cos(half)[..., np.newaxis], axes * np.sin(half)[..., np.newaxis]], axis=-1)
+    return quaternions_to_matrices(quats)
+
+def eulers_to_matrices(eulers, order='XYZ'):
+    """Convert (..., 3) euler angles with the specified Blender rotation order
+    to (..., 3, 3) rotation matrices.
+    """
+    i, j, k = ['XYZ'.index(axis) for axis in order]
+    mats = matmul(_axis_matrices(k, eulers[..., k]), _axis_matrices(j, eulers[..., j]))
+    return matmul(mats, _axis_matrices(i, eulers[..., i]))
+
+def compose_matrices(rot, loc=None, scale=None):
+    """Compose (..., 4, 4) matrices from (..., 3, 3) rotation matrices and
+    optional (..., 3) translations and scales.
+    """
+    mats = np.zeros(rot.shape[:-2] + (4, 4), dtype=np.float64)
+    mats[..., :3, :3] = rot if scale is None else rot * np.asarray(scale)[..., np.newaxis, :]
+    if loc is not None:
+        mats[..., :3, 3] = loc
+    mats[..., 3, 3] = 1.0
+    return mats
+
+def depth_order(parent_indices):
+    """Order bone indices so that every bone comes after its parent.
+    """
+    depths = np.zeros(len(parent_indices), dtype=np.int32)
+    for b_idx in range(len(parent_indices)):
+        p_idx = parent_indices[b_idx]
+        while p_idx >= 0:
+            depths[b_idx] += 1
+            p_idx = parent_indices[p_idx]
+    return np.argsort(depths, kind='mergesort')
+
+def global_matrices(basis, rest, parent_indices):
+    """Calculate global bone matrices M_b = M_p R_p^-1 R_b L_b for a stack of
+    poses. basis is an (F, B, 4, 4) array of local pose matrices L_b, rest a
+    (B, 4, 4) array of rest matrices R_b.
+    """
+    parent_indices = np.asarray(parent_indices)
+    rel_rest = rest.copy()
+    has_parent = parent_indices >= 0
+    rel_rest[has_parent] = np.linalg.solve(rest[parent_indices[has_parent]], rest[has_parent])
+
+    mats = np.empty_like(basis)
+    for b_idx in depth_order(parent_indices):
+        local = matmul(rel_rest[b_idx], basis[:, b_idx])
+        p_idx = parent_indices[b_idx]
+        mats[:, b_idx] = matmul(mats[:, p_idx], local) if p_idx >= 0 else local
+    return mats
+
+def bone_matrices(rest, parent_indices):
+    """Bone matrices B_b = R_b^-1 R_p for a (B, 4, 4) array of rest matrices.
+    """
+    parent_indices = np.asarray(parent_indices)
+    b_mats = invert(rest)
+    has_parent = parent_indices >= 0
+    b_mats[has_parent] = matmul(b_mats[has_parent], rest[parent_indices[has_parent]])
+    return b_mats
+
+def rest_compensation_matrices(src_rest, trg_rest):
+    """Rest pose compensation matrices A_b = M_src^-1 M_trg, from the global
+    matrices of source and target bones in rest pose.
+    """
+    return matmul(invert(src_rest), trg_rest)
+
+def retarget_matrices(src_mats, a_mats, b_mats, parent_indices):
+    """Retarget a stack of source poses. src_mats is an (F, B, 4, 4) array of
+    global source bone matrices, a_mats and b_mats (B, 4, 4) arrays with the A_b
+    and B_b matrices of every bone, and parent_indices the index of the target
+    parent of every bone.
+    Returns the (F, B, 4, 4) local target pose matrices:
+        T_b = M_b A_b (with the translation of M_b)
+        L_b = B_b T_p^-1 T_b
+    """
+    parent_indices = np.asarray(parent_indices)
+    trg_mats = matmul(src_mats, a_mats)
+    trg_mats[..., :, 3] = src_mats[..., :, 3]
+
+    pose_mats = trg_mats.copy()
+    has_parent = parent_indices >= 0
+    if has_parent.any():
+        parent_inv = invert(trg_mats[:, parent_indices[has_parent]])
+        pose_mats[:, has_parent] = matmul(parent_inv, trg_mats[:, has_parent])
+    return matmul(b_mats, pose_mats)
+
+
+#
+#   Benchmark
+#
+
+def synthetic_skeleton(n_bones, rng):
+    """Random skeleton with n_bones bones. Returns (parent_indices, rest)
+    with (B, 4, 4) rest matrices.
+    """
+    parent_indices = np.array([-1] + [rng.randint(0, b_idx) for b_idx in range(1, n_bones)], dtype=np.int32)
+    rot = eulers_to_matrices(rng.uniform(-np.pi, np.pi, (n_bones, 3)))
+    heads = np.zeros((n_bones, 3))
+    for b_idx in range(1, n_bones):
+        heads[b_idx] = heads[parent_indices[b_idx]] + rng.uniform(-1, 1, 3)
+    return parent_indices, compose_matrices(rot, heads)
+
+def synthetic_poses(n_frames, n_bones, rng):
+    """Random (F, B, 4, 4) local pose matrices, with translations on the root
+    bone only.
+    """
+    rot = eulers_to_matrices(rng.uniform(-np.pi, np.pi, (n_frames, n_bones, 3)))
+    loc = np.zeros((n_frames, n_bones, 3))
+    loc[:, 0] = rng.uniform(-1, 1, (n_frames, 3))
+    return compose_matrices(rot, loc)
+
+def benchmark(n_frames=1000, n_bones=160, seed=0):
+    """Measure retarget throughput on a synthetic skeleton. Returns the number
+    of bone frames (frames x bones) retargeted per second.
+    """
+    rng = np.random.RandomState(seed)
+    parents, src_rest = synthetic_skeleton(n_bones, rng)
+    _, trg_rest = synthetic_skeleton(n_bones, rng)
+    src_mats = global_matrices(synthetic_poses(n_frames, n_bones, rng), src_rest, parents)
+    a_mats = rest_compensation_matrices(src_rest, trg_rest)
+    b_mats = bone_matrices(trg_rest, parents)
+
+    start = time.time()
+    pose_mats = retarget_matrices(src_mats, a_mats, b_mats, parents)
+    matrices_to_quaternions(pose_mats)
+    elapsed = max(time.time() - start, 1e-9)
+    return n_frames * n_bones / elapsed
+
+
+if __name__ == '__main__':
+    for n_frames, n_bones in [(100, 30), (1000, 160), (10000, 160)]:
+        print ("%6d frames x %4d bones: %12.0f bone frames/s" % (n_frames, n_bones, benchmark(n_frames, n_bones)))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The weighting modules that do not use bpy are imported directly from their
+# folder. standalone must come before numpy, see weighting/standalone.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "weighting"))
+import standalone
@@ -0,0 +1,148 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "animation_retarget"))
+import pose_math
+from pose_math import synthetic_skeleton, synthetic_poses
+
+
+N_FRAMES = 20
+N_BONES = 30
+SEEDS = [0, 1, 2]
+
+#
+#   Per-bone references, transcribed from the mathutils code in
+#   animation_retarget_mh and from Blender's pose evaluation
+#
+
+def inv(mat):
+    return np.linalg.inv(mat)
+
+
+def pose_bone_matrices(basis, rest, parents):
+    """PoseBone.matrix of every bone: M_b = M_p R_p^-1 R_b L_b"""
+    mats = {}
+    for b_idx in pose_math.depth_order(parents):
+        p_idx = parents[b_idx]
+        if p_idx >= 0:
+            mats[b_idx] = mats[p_idx].dot(inv(rest[p_idx])).dot(rest[b_idx]).dot(basis[b_idx])
+        else:
+            mats[b_idx] = rest[b_idx].dot(basis[b_idx])
+    return np.array([mats[b_idx] for b_idx in range(len(parents))])
+
+
+def bone_matrix(rest, parents, b_idx):
+    """_get_bone_matrix(): B_b = R_b^-1 R_p"""
+    p_idx = parents[b_idx]
+    if p_idx >= 0:
+        return inv(rest[b_idx]).dot(rest[p_idx])
+    return inv(rest[b_idx])
+
+
+def retarget_frame(src_mats, a_mats, b_mats, parents):
+    """Per-bone retarget of one frame, as the old BoneMapping.retarget_frame()
+    did it: T_b = M_b A_b with the translation of M_b, L_b = B_b T_p^-1 T_b,
+    where T_p is rebuilt from the parent's result"""
+    trg_mats = {}
+    result = np.empty_like(src_mats)
+    for b_idx in pose_math.depth_order(parents):
+        frame_mat = src_mats[b_idx]
+        trg_mat = frame_mat.dot(a_mats[b_idx])
+        trg_mat[:3, 3] = frame_mat[:3, 3]
+        p_idx = parents[b_idx]
+        mat = inv(trg_mats[p_idx]).dot(trg_mat) if p_idx >= 0 else trg_mat
+        mat = b_mats[b_idx].dot(mat)
+        local = inv(b_mats[b_idx]).dot(mat)
+        trg_mats[b_idx] = trg_mats[p_idx].dot(local) if p_idx >= 0 else local
+        result[b_idx] = mat
+    return result
+
+
+def rest_pose(n_bones, rng, identity):
+    """Local matrices of the pose a rig is put in before the rest pose
+    compensation matrices are taken"""
+    if identity:
+        return np.tile(np.identity(4), (n_bones, 1, 1))
+    return synthetic_poses(1, n_bones, rng)[0]
+
+
+def random_rigs(seed, identity_rest):
+    rng = np.random.RandomState(seed)
+    parents, src_rest = synthetic_skeleton(N_BONES, rng)
+    _, trg_rest = synthetic_skeleton(N_BONES, rng)
+    src_rest_pose = rest_pose(N_BONES, rng, identity_rest)
+    trg_rest_pose = rest_pose(N_BONES, rng, identity_rest)
+    return rng, parents, src_rest, trg_rest, src_rest_pose, trg_rest_pose
+
+#
+#   Tests
+#
+
+@pytest.mark.parametrize("order", ['XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX'])
+def test_rotation_conversions_round_trip(order):
+    rng = np.random.RandomState(0)
+    eulers = rng.uniform(-1.5, 1.5, (N_FRAMES, 3))
+    mats = pose_math.eulers_to_matrices(eulers, order)
+    assert np.allclose(pose_math.matrices_to_eulers(mats, order), eulers)
+    assert np.allclose(pose_math.quaternions_to_matrices(pose_math.matrices_to_quaternions(mats)), mats)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_global_matrices_match_pose_bones(seed):
+    rng = np.random.RandomState(seed)
+    parents, rest = synthetic_skeleton(N_BONES, rng)
+    basis = synthetic_poses(N_FRAMES, N_BONES, rng)
+    result = pose_math.global_matrices(basis, rest, parents)
+    for f_idx in range(N_FRAMES):
+        assert np.allclose(result[f_idx], pose_bone_matrices(basis[f_idx], rest, parents), atol=1e-8)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_bone_matrices_match_reference(seed):
+    rng = np.random.RandomState(seed)
+    parents, rest = synthetic_skeleton(N_BONES, rng)
+    b_mats = pose_math.bone_matrices(rest, parents)
+    for b_idx in range(N_BONES):
+        assert np.allclose(b_mats[b_idx], bone_matrix(rest, parents, b_idx), atol=1e-8)
+
+
+@pytest.mark.parametrize("identity_rest", [True, False])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_retarget_matches_per_bone_reference(seed, identity_rest):
+    rng, parents, src_rest, trg_rest, src_rest_pose, trg_rest_pose = random_rigs(seed, identity_rest)
+    # _get_rest_pose_compensation_matrix(): A_b = M_src^-1 M_trg in rest pose
+    src_rest_mats = pose_bone_matrices(src_rest_pose, src_rest, parents)
+    trg_rest_mats = pose_bone_matrices(trg_rest_pose, trg_rest, parents)
+    a_mats = np.array([inv(src_rest_mats[b_idx]).dot(trg_rest_mats[b_idx]) for b_idx in range(N_BONES)])
+    b_mats = np.array([bone_matrix(trg_rest, parents, b_idx) for b_idx in range(N_BONES)])
+    assert np.allclose(pose_math.rest_compensation_matrices(src_rest_mats, trg_rest_mats), a_mats, atol=1e-8)
+
+    src_mats = pose_math.global_matrices(synthetic_poses(N_FRAMES, N_BONES, rng), src_rest, parents)
+    result = pose_math.retarget_matrices(src_mats, a_mats, b_mats, parents)
+    for f_idx in range(N_FRAMES):
+        assert np.allclose(result[f_idx], retarget_frame(src_mats[f_idx], a_mats, b_mats, parents), atol=1e-8)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_retarget_onto_same_skeleton_keeps_the_pose(seed):
+    rng = np.random.RandomState(seed)
+    parents, rest = synthetic_skeleton(N_BONES, rng)
+    basis = synthetic_poses(N_FRAMES, N_BONES, rng)
+    src_mats = pose_math.global_matrices(basis, rest, parents)
+    identity = np.tile(np.identity(4), (N_BONES, 1, 1))
+    result = pose_math.retarget_matrices(src_mats, identity, pose_math.bone_matrices(rest, parents), parents)
+    assert np.allclose(result, basis, atol=1e-8)
+
+
+@pytest.mark.parametrize("identity_rest", [True, False])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_source_rest_pose_maps_to_target_rest_pose(seed, identity_rest):
+    rng, parents, src_rest, trg_rest, src_rest_pose, trg_rest_pose = random_rigs(seed, identity_rest)
+    src_rest_mats = pose_math.global_matrices(src_rest_pose[np.newaxis], src_rest, parents)
+    trg_rest_mats = pose_math.global_matrices(trg_rest_pose[np.newaxis], trg_rest, parents)[0]
+    a_mats = pose_math.rest_compensation_matrices(src_rest_mats[0], trg_rest_mats)
+    result = pose_math.retarget_matrices(src_rest_mats, a_mats, pose_math.bone_matrices(trg_rest, parents), parents)
+    # Translations follow the source, rotations the target rest pose
+    assert np.allclose(result[0, :, :3, :3], trg_rest_pose[:, :3, :3], atol=1e-8)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from topology import CTopology, vertexRows
+
+
+def edgeTopology(nVerts, edges):
+    edges = np.array(edges, dtype=np.int32).reshape(-1,2)
+    empty = np.zeros(0, dtype=np.int32)
+    return CTopology(nVerts, edges, empty, empty, empty, empty)
+
+
+def eyeRing(nVerts=8):
+    """Ring of vertices around an eye in the XZ plane, numbered around the
+    ring starting at the inner corner, with the upper lid at z > 0"""
+    angles = np.pi - 2*np.pi*np.arange(nVerts)/nVerts
+    coords = np.column_stack((np.cos(angles), np.zeros(nVerts), 0.5*np.sin(angles)))
+    edges = [(vn, (vn+1) % nVerts) for vn in range(nVerts)]
+    return edgeTopology(nVerts, edges), coords
+
+
+def test_chain_is_ordered_along_edges():
+    coords = np.array([[0,0,0], [2,0,0], [1,0,1], [3,0,0]], dtype=float)
+    topo = edgeTopology(4, [(0,2), (2,1), (1,3)])
+    rows = vertexRows(topo, [3,1,2,0], coords)
+    assert [row.tolist() for row in rows] == [[0,2,1,3]]
+
+
+def test_closed_ring_is_split_at_the_corners():
+    topo,coords = eyeRing(8)
+    rows = vertexRows(topo, np.arange(8), coords)
+    assert len(rows) == 2
+    upper,lower = sorted(rows, key=lambda row: -coords[row,2].mean())
+    assert upper.tolist() == [0,1,2,3,4]
+    assert lower.tolist() == [0,7,6,5,4]
+    for row in rows:
+        # Both rows run from the inner to the outer corner without zig-zag
+        assert np.all(np.diff(coords[row,0]) > 0)
+    assert np.all(coords[upper[1:-1],2] > 0)
+    assert np.all(coords[lower[1:-1],2] < 0)
+
+
+def test_closed_ring_with_branch_is_rejected():
+    topo,coords = eyeRing(8)
+    edges = np.vstack((topo.edges, [(2,8)]))
+    topo = edgeTopology(9, edges)
+    coords = np.vstack((coords, [[0,0,1]]))
+    with pytest.raises(ValueError):
+        vertexRows(topo, np.arange(9), coords)
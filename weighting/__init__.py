@@ -49,6 +49,15 @@ bl_info = {
 if "bpy" in locals():
     print("Reloading MH weighting tools v %d.%03d" % bl_info["version"])
     import imp
+    imp.reload(selection)
+    imp.reload(topology)
+    imp.reload(objfile)
+    imp.reload(cache)
+    imp.reload(proxy)
+    imp.reload(fit_proxies)
+    imp.reload(targets)
+    imp.reload(splits)
+    imp.reload(faceshapes)
     imp.reload(numbers)
     imp.reload(genrig)
     imp.reload(vgroup)
@@ -63,6 +72,15 @@ else:
     import bpy
     import os
     from bpy.props import *
+    from . import selection
+    from . import topology
+    from . import objfile
+    from . import cache
+    from . import proxy
+    from . import fit_proxies
+    from . import targets
+    from . import splits
+    from . import faceshapes
     from . import numbers
     from . import genrig
     from . import vgroup
@@ -169,12 +187,21 @@ class MhxVGroupsPanel(bpy.types.Panel):
         layout.prop(context.scene, 'MhxBone1')
         layout.prop(context.scene, 'MhxBone2')
         layout.operator("mhw.pair_weight")
+        layout.prop(scn, 'MhxRampAxis')
+        if scn.MhxRampAxis == 'CUSTOM':
+            layout.prop(scn, 'MhxRampDirection')
+        layout.prop(scn, 'MhxRampFalloff')
         layout.operator("mhw.ramp_weight")
+        layout.prop(scn, 'MhxBlendSides')
+        layout.prop(scn, 'MhxBlendWidth')
+        layout.prop(scn, 'MhxBlendFalloff')
         layout.operator("mhw.create_left_right")
+        layout.operator("mhw.save_blend_mask")
 
         layout.separator()
         layout.operator("mhw.weight_lid", text="Weight Upper Left Lid").lidname = "uplid.L"
         layout.operator("mhw.weight_lid", text="Weight Lower Left Lid").lidname = "lolid.L"
+        layout.operator("mhw.weight_lid", text="Weight All Lids").lidname = "AUTO"
 
 
 class MhxSymmetryPanel(bpy.types.Panel):
@@ -290,6 +317,7 @@ class MhxHelpersPanel(bpy.types.Panel):
         layout.operator("mhw.join_meshes")
         layout.operator("mhw.fix_base_file")
         layout.operator("mhw.project_weights")
+        layout.operator("mhw.fit_proxies")
         layout.operator("mhw.smoothen_skirt")
         layout.operator("mhw.project_materials")
         layout.operator("mhw.export_base_obj")
@@ -327,6 +355,50 @@ def initInterface(context):
         default=1.0,
         min=0, max=1)
 
+    bpy.types.Scene.MhxBlendSides = EnumProperty(
+        items = [('LR', "Left/Right", "Split along X"),
+                 ('FB', "Front/Back", "Split along Y"),
+                 ('UL', "Upper/Lower", "Split along Z")],
+        name="Sides",
+        description="Sides of the blend mask",
+        default='LR')
+
+    bpy.types.Scene.MhxBlendWidth = FloatProperty(
+        name="Blend Width",
+        description="Half width of the band where the sides blend",
+        default=0.1,
+        min=0.001, max=10)
+
+    bpy.types.Scene.MhxBlendFalloff = EnumProperty(
+        items = [('LINEAR', "Linear", "Linear falloff"),
+                 ('SMOOTH', "Smooth", "Smoothstep falloff"),
+                 ('SINE', "Sine", "Cosine falloff")],
+        name="Falloff",
+        description="Falloff curve of the blend mask",
+        default='LINEAR')
+
+    bpy.types.Scene.MhxRampAxis = EnumProperty(
+        items = [('X', "X", "Ramp along X"),
+                 ('Y', "Y", "Ramp along Y"),
+                 ('Z', "Z", "Ramp along Z"),
+                 ('CUSTOM', "Custom", "Ramp along the ramp direction")],
+        name="Ramp Axis",
+        description="Direction of the weight ramp",
+        default='X')
+
+    bpy.types.Scene.MhxRampDirection = FloatVectorProperty(
+        name="Ramp Direction",
+        size=3,
+        default=(1,0,0))
+
+    bpy.types.Scene.MhxRampFalloff = EnumProperty(
+        items = [('LINEAR', "Linear", "Linear ramp"),
+                 ('SMOOTH', "Smooth", "Smoothstep ramp"),
+                 ('SINE', "Sine", "Cosine ramp")],
+        name="Ramp Falloff",
+        description="Easing curve of the weight ramp",
+        default='LINEAR')
+
     bpy.types.Scene.MhxBone1 = StringProperty(
         name="Bone 1",
         maxlen=40,
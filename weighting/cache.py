@@ -0,0 +1,121 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+File caches
+
+Arrays read from data files are cached in .npz files next to them, keyed by
+the modification time and size of the data file. Caches are written to a
+temporary file in the same folder and renamed into place, so a process that
+is killed mid-write, or another process reading at the same time, never sees
+a partly written cache. Unreadable caches count as missing. Other generated
+files can be written the same way with writeAtomic and saveText.
+This module does not use bpy.
+"""
+
+import os
+import tempfile
+import zipfile
+import numpy as np
+
+#
+#   fileStamp(filepath):
+#
+
+def fileStamp(filepath):
+    stat = os.stat(filepath)
+    return np.array([stat.st_mtime, stat.st_size], dtype=np.float64)
+
+#
+#   getUmask():
+#
+
+def getUmask():
+    """The file mode creation mask of the process. It can only be read by
+    setting it, so it is set back right away."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+#
+#   loadCache(cachepath, stamp):
+#   saveCache(cachepath, stamp, **arrays):
+#
+
+def loadCache(cachepath, stamp):
+    """Dict of the arrays of a cache, or None if it is missing, stale or
+    unreadable"""
+    if not os.path.isfile(cachepath):
+        return None
+    try:
+        with np.load(cachepath) as data:
+            if np.array_equal(data["stamp"], stamp):
+                return dict((key, data[key]) for key in data.files)
+    except (IOError, OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        pass
+    return None
+
+
+def saveCache(cachepath, stamp, **arrays):
+    """Write a cache atomically. Failures are ignored, the cache is then
+    just rebuilt next time."""
+    try:
+        writeAtomic(cachepath, lambda fp: np.savez(fp, stamp=stamp, **arrays))
+    except (IOError, OSError):
+        pass
+
+#
+#   writeAtomic(filepath, write):
+#   saveText(filepath, text):
+#
+
+def writeAtomic(filepath, write):
+    """Call write with a binary file object of a temporary file in the folder
+    of filepath, and rename the temporary file to filepath when done. On
+    errors the temporary file is removed and the error raised."""
+    tmppath = None
+    try:
+        fd,tmppath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(filepath)))
+        with os.fdopen(fd, "wb") as fp:
+            write(fp)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmppath, 0o666 & ~getUmask())
+        os.replace(tmppath, filepath)
+    except BaseException:
+        if tmppath and os.path.isfile(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def saveText(filepath, text):
+    """Write a UTF-8 text file atomically"""
+    writeAtomic(filepath, lambda fp: fp.write(text.encode("utf-8")))
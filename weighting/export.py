@@ -36,9 +36,14 @@ Export
 """
 
 import bpy
+from bpy.props import *
 import os
+import numpy as np
 from collections import OrderedDict
 from . import io_json
+from .numbers import getCoords
+from .objfile import formatLines
+from .splits import blendMasks, saveVertexGroups, CSplitWeights, SplitFiles, BlendFiles
 
 
 def sortVertexGroups(ob):
@@ -115,24 +120,13 @@ def exportLeftRight(context):
     scn = context.scene
     filepath = scn.MhxVertexGroupFile
     filename = os.path.expanduser(filepath)
-    fp = open(filename, "w")
     ob = context.object
-    eps = 0.07
-    left = []
-    right = []
-    for v in ob.data.vertices:
-        if v.co[0] > eps:
-            left.append((v.index, 1.0))
-        elif v.co[0] < -eps:
-            right.append((v.index, 1.0))
-        else:
-            w = (v.co[0] + eps)/(2*eps)
-            left.append((v.index, w))
-            right.append((v.index, 1-w))
-    exportList(context, left, "Left", fp)
-    exportList(context, right, "Right", fp)
-    fp.close()
-    print("Left-right vertex groups exported to %s" % filename)
+    names,weights = blendMasks(getCoords(ob.data), scn.MhxBlendSides, scn.MhxBlendWidth, scn.MhxBlendFalloff)
+    verts = np.arange(len(ob.data.vertices))
+    with open(filename, "w") as fp:
+        for name,row in zip(names, weights):
+            exportWeights(context, verts, row, name, fp)
+    print("%s vertex groups exported to %s" % ("-".join(names), filename))
     return
 
 
@@ -146,6 +140,41 @@ class VIEW3D_OT_ExportLeftRightButton(bpy.types.Operator):
         return{'FINISHED'}
 
 
+#
+#    class VIEW3D_OT_SaveBlendMaskButton(bpy.types.Operator):
+#
+
+class VIEW3D_OT_SaveBlendMaskButton(bpy.types.Operator):
+    bl_idname = "mhw.save_blend_mask"
+    bl_label = "Save Blend Mask"
+    bl_description = "Save the blend mask in the vertex group format used for faceshapes"
+
+    filepath = StringProperty(name="File Path", maxlen=1024, default="")
+
+    def execute(self, context):
+        scn = context.scene
+        filepath = os.path.realpath(os.path.expanduser(self.properties.filepath))
+        splitFiles = [os.path.realpath(path) for path in SplitFiles]
+        if filepath in splitFiles and filepath != os.path.realpath(BlendFiles[scn.MhxBlendSides]):
+            # The faceshape build needs the groups of the shipped files
+            self.report({'ERROR'}, "%s cannot be overwritten with %s blend masks" %
+                (os.path.basename(filepath), scn.MhxBlendSides))
+            return{'CANCELLED'}
+        split = CSplitWeights()
+        if os.path.isfile(filepath):
+            # Keep the other groups of the file
+            split.addVertexGroups(filepath, useCache=False)
+        split.addBlend(getCoords(context.object.data), scn.MhxBlendSides, scn.MhxBlendWidth, scn.MhxBlendFalloff)
+        saveVertexGroups(filepath, split)
+        return{'FINISHED'}
+
+    def invoke(self, context, event):
+        if not self.properties.filepath:
+            self.properties.filepath = BlendFiles[context.scene.MhxBlendSides]
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
 class VIEW3D_OT_ExportCustomShapesButton(bpy.types.Operator):
     bl_idname = "mhw.export_custom_shapes"
     bl_label = "Export Custom Shapes"
@@ -202,21 +231,23 @@ def exportSumGroups(context):
 
 def exportList(context, weights, name, fp):
     print("EL", name)
+    weights = list(weights)
     if len(weights) == 0:
         return
+    pairs = np.array(weights, dtype=np.float64).reshape(-1,2)
+    exportWeights(context, pairs[:,0].astype(np.int32), pairs[:,1], name, fp)
+    return
+
+def exportWeights(context, verts, weights, name, fp):
     scn = context.scene
-    offset = scn.MhxVertexOffset
+    keep = (weights > 0.005)
+    rows = np.column_stack((verts[keep] + scn.MhxVertexOffset, weights[keep]))
     if scn.MhxExportAsWeightFile:
-        if len(weights) > 0:
-            fp.write("\n# weights %s\n" % name)
-            for (vn,w) in weights:
-                if w > 0.005:
-                    fp.write("  %d %.3g\n" % (vn+offset, w))
+        fp.write("\n# weights %s\n" % name)
+        fp.write(formatLines("  %d %.3g\n", rows))
     else:
         fp.write("\n  VertexGroup %s\n" % name)
-        for (vn,w) in weights:
-            if w > 0.005:
-                fp.write("    wv %d %.3g ;\n" % (vn+offset, w))
+        fp.write(formatLines("    wv %d %.3g ;\n", rows))
         fp.write("  end VertexGroup %s\n" % name)
     return
 
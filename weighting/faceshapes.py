@@ -0,0 +1,291 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Faceshape builder
+
+Reads the raw face targets in worker processes, splits them into parts with
+the split weights of splits.py, e.g. into left and right halves, and streams
+every finished target into faceshapes.json in the order of the target names.
+The file is the same as one written with
+io_json.saveJson(struct, filepath, maxDepth=0).
+
+Optionally all targets are also written to a bundle folder, with one
+uncompressed .npy file per array, so that the arrays can be memory-mapped:
+
+    names.npy       target names
+    starts.npy      (T+1) int64, the rows of target t are starts[t]:starts[t+1]
+    indices.npy     int32 vertex indices of all targets
+    offsets.npy     (N,3) float32 offsets of all targets
+    scale.npy       (3,3) float32, vertex 1, vertex 2 and factor for x, y and z
+
+This module does not use bpy, and can be run outside Blender:
+
+    python faceshapes.py mhx_folder [--bundle] [-j processes]
+"""
+
+import os
+if not __package__:
+    # Run as a script
+    import standalone
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+try:
+    from . import io_json
+    from .targets import loadTarget
+    from .splits import loadSplitWeights
+except (ImportError, SystemError, ValueError):
+    # Run as a script
+    import io_json
+    from targets import loadTarget
+    from splits import loadSplitWeights
+
+
+SplitInfo = {
+    "brow_mid_up"           : "LR",
+    "brow_mid_down"         : "LR",
+    "brow_outer_up"         : "LR",
+    "brow_outer_down"       : "LR",
+    "brow_squeeze"          : "Sym",
+
+    "cheek_narrow"          : "LR",
+    "cheek_balloon"         : "LR",
+    "cheek_up"              : "LR",
+    "cheek_squint"          : "LR",
+
+    "lips_mid_upper_up"     : "LR",
+    "lips_mid_lower_up"     : "LR",
+    "lips_mid_upper_down"   : "LR",
+    "lips_mid_lower_down"   : "LR",
+    "lips_upper_in"         : "Sym",
+    "lips_lower_in"         : "Sym",
+    "lips_upper_out"        : "Sym",
+    "lips_lower_out"        : "Sym",
+    "lips_part"             : "Sym",
+
+    "mouth_corner_in"       : "LR",
+    "mouth_corner_out"      : "LR",
+    "mouth_corner_up"       : "LR",
+    "mouth_corner_down"     : "LR",
+    "mouth_up"              : "LR",
+    "mouth_down"            : "LR",
+    "mouth_narrow"          : "LR",
+    "mouth_open"            : "Sym",
+    "mouth_wide"            : "LR",
+
+    "nose_wrinkle"          : "Sym",
+
+    "tongue_back_up"        : "Sym",
+    "tongue_out"            : "Sym",
+    "tongue_up"             : "Sym",
+    "tongue_wide"           : "Sym",
+}
+
+# Split weights of each kind of split. Parts are named <target>_<split>.
+SplitSets = {
+    "Sym" : [],
+    "LR" : ["Left", "Right"],
+    "UL" : ["Upper", "Lower"],
+}
+
+Scales = {
+    "base" : {
+        "x" : (5399, 11998, 1.4800),
+        "y" : (791, 881, 2.3298),
+        "z" : (962, 5320, 1.9221),
+    },
+}
+
+RawFolder = "plugins/9_export_xmhx/data/faceshapes/raw/"
+FaceshapesFile = "plugins/9_export_xmhx/data/faceshapes/faceshapes.json"
+
+#
+#   encodeTarget(indices, offsets):
+#
+
+def encodeTarget(indices, offsets):
+    """The JSON list [[n, [x, y, z]], ...] as encoded by io_json.encodeJsonData"""
+    if len(indices) == 0:
+        return "[]"
+    offsets = np.asarray(offsets, dtype=np.float64)
+    offsets = np.where(np.abs(offsets) < 1e-7, 0.0, offsets)
+    rows = np.column_stack((indices, offsets))
+    string = ("[%d, [%g, %g, %g]], " * len(rows)) % tuple(rows.ravel().tolist())
+    return "[" + string[:-2] + "]"
+
+#
+#   Worker processes
+#
+
+_Splits = None
+
+def _initWorker(splits):
+    global _Splits
+    _Splits = splits
+
+
+def _buildTarget(task):
+    """List of (name, JSON string, indices, offsets) of the parts of a target"""
+    fname,filepath,splitNames = task
+    indices,offsets = loadTarget(filepath, dtype=np.float64)
+    if splitNames:
+        names = ["%s_%s" % (fname, name.lower()) for name in splitNames]
+        parts = _Splits.split(indices, offsets, splitNames)
+    else:
+        names = [fname]
+        keep = np.any(np.abs(offsets) >= 1e-5, axis=1)
+        parts = [(indices[keep], offsets[keep])]
+    return [(name, encodeTarget(indices, offsets), indices, offsets)
+        for name,(indices,offsets) in zip(names, parts)]
+
+#
+#   buildFaceshapes(tasks, splits, scale, filepath, bundlepath=None, processes=None):
+#
+
+def buildFaceshapes(tasks, splits, scale, filepath, bundlepath=None, processes=None):
+    """Build faceshapes.json from tasks (target name, target path, split
+    names), where splits is a splits.CSplitWeights. Targets are written in
+    task order.
+    processes is the number of worker processes, by default one per cpu.
+    With processes=1 everything runs in this process."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+    if processes == 1:
+        _initWorker(splits)
+        pool = None
+        results = map(_buildTarget, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _initWorker, (splits,))
+        results = pool.imap(_buildTarget, tasks)
+
+    names = []
+    indexList = []
+    offsetList = []
+    try:
+        with open(filepath, "w", encoding="utf-8") as fp:
+            fp.write('{\n    "scale" : %s,\n    "targets" : ' % io_json.encodeJson(scale, 0, "    "))
+            for parts in results:
+                for name,string,indices,offsets in parts:
+                    fp.write('%s\n        "%s" : %s' % ("," if names else "{", name, string))
+                    names.append(name)
+                    if bundlepath:
+                        indexList.append(indices)
+                        offsetList.append(offsets)
+            fp.write("\n    }" if names else "{}")
+            fp.write("\n}\n")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    print("Faceshapes saved to %s" % filepath)
+
+    if bundlepath:
+        counts = [len(indices) for indices in indexList]
+        saveFaceshapeBundle(bundlepath,
+            names = np.array(names, dtype=str),
+            starts = np.concatenate(([0], np.cumsum(counts, dtype=np.int64))),
+            indices = np.concatenate(indexList + [np.zeros(0, dtype=np.int32)]).astype(np.int32),
+            offsets = np.concatenate(offsetList + [np.zeros((0,3))]).astype(np.float32),
+            scale = np.array([scale[key] for key in ("x","y","z")], dtype=np.float32))
+        print("Faceshape bundle saved to %s" % bundlepath)
+
+#
+#   saveFaceshapeBundle(folder, **arrays):
+#   loadFaceshapeBundle(folder):
+#
+
+BundleArrays = ["names", "starts", "indices", "offsets", "scale"]
+
+def saveFaceshapeBundle(folder, **arrays):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for key in BundleArrays:
+        np.save(os.path.join(folder, key + ".npy"), arrays[key])
+
+
+def loadFaceshapeBundle(folder):
+    """Scale table and an OrderedDict of (indices, offsets) per target. The
+    bundle arrays are memory-mapped, and the arrays of the targets are views
+    into them, so target data is only read from disk when it is used."""
+    data = dict((key, np.load(os.path.join(folder, key + ".npy"), mmap_mode='r'))
+        for key in BundleArrays)
+    starts = np.array(data["starts"])
+    indices = data["indices"]
+    offsets = data["offsets"]
+    targets = OrderedDict()
+    for n,name in enumerate(data["names"]):
+        targets[str(name)] = (indices[starts[n]:starts[n+1]], offsets[starts[n]:starts[n+1]])
+    return np.array(data["scale"]), targets
+
+#
+#   generateFaceshapes(folder, splits, bundle=False, processes=None):
+#
+
+def getFaceshapeTasks(raw):
+    """Tasks for all targets in the raw folder, sorted by target name"""
+    tasks = []
+    for file in sorted(os.listdir(raw)):
+        fname,ext = os.path.splitext(file)
+        if ext == ".target":
+            tasks.append((fname, os.path.join(raw, file), SplitSets[SplitInfo[fname]]))
+    return tasks
+
+
+def generateFaceshapes(folder, splits=None, bundle=False, processes=None):
+    if splits is None:
+        # Double precision keeps the output independent of rounding
+        splits = loadSplitWeights(dtype=np.float64)
+    tasks = getFaceshapeTasks(os.path.join(folder, RawFolder))
+    filepath = os.path.join(folder, FaceshapesFile)
+    bundlepath = (os.path.splitext(filepath)[0] + "_bundle" if bundle else None)
+    buildFaceshapes(tasks, splits, Scales["base"], filepath, bundlepath, processes)
+
+
+#
+#   main():
+#
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate faceshapes.json from the raw face targets")
+    parser.add_argument("folder", help="mhx system folder")
+    parser.add_argument("--bundle", action="store_true", help="also write the faceshapes_bundle folder")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+    generateFaceshapes(args.folder, None, args.bundle, args.processes)
+
+
+if __name__ == '__main__':
+    main()
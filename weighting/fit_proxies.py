@@ -0,0 +1,228 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Batch proxy weight fitting
+
+Projects the vertex group weights of the base mesh onto every .mhclo proxy in
+a folder, in worker processes, and writes one <proxy>.weights.json file per
+proxy in the format of Export vertex groups. A manifest in the output folder
+holds a hash of the base weights and the .mhclo file of every proxy, and
+proxies whose inputs are unchanged are skipped.
+
+This module does not use bpy, and can be run outside Blender:
+
+    python fit_proxies.py base_weights.json proxy_folder [output_folder] [-j processes]
+
+where base_weights.json is a file written by Export vertex groups.
+"""
+
+import os
+if not __package__:
+    # Run as a script
+    import standalone
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+
+try:
+    from . import io_json
+    from .cache import saveText
+    from .proxy import CProxy
+    from .objfile import formatLines
+except (ImportError, SystemError, ValueError):
+    # Run as a script
+    import io_json
+    from cache import saveText
+    from proxy import CProxy
+    from objfile import formatLines
+
+ManifestFile = "fit_proxies.json"
+MinWeight = 0.005
+
+#
+#   loadBaseWeights(filepath):
+#   saveProxyWeights(filepath, names, weights):
+#
+
+def loadBaseWeights(filepath):
+    """Group names and dense (V,G) weight matrix from a vertex group file"""
+    groups = io_json.loadJson(filepath)
+    names = [name for name,_ in groups]
+    pairs = [np.array(weights, dtype=np.float64).reshape(-1,2) for _,weights in groups]
+    nVerts = 1 + max([int(vw[:,0].max()) for vw in pairs if len(vw)] + [-1])
+    matrix = np.zeros((nVerts, len(names)), dtype=np.float32)
+    for gn,vw in enumerate(pairs):
+        matrix[vw[:,0].astype(np.int32), gn] = vw[:,1]
+    return names, matrix
+
+
+def saveProxyWeights(filepath, names, weights):
+    """Write the (N,G) proxy weights in the layout of io_json.saveJson with
+    maxDepth=0. Weights below MinWeight are dropped."""
+    weights = np.round(weights, 4)
+    lines = []
+    for gn,name in enumerate(names):
+        verts = np.flatnonzero(weights[:,gn] > MinWeight)
+        if len(verts):
+            pairs = formatLines("[%d, %g], ", np.column_stack((verts, weights[verts,gn])))
+            lines.append('    ["%s", [%s]]' % (name, pairs[:-2]))
+    saveText(filepath, "[\n" + ",\n".join(lines) + "\n]\n")
+
+#
+#   Content hashes
+#
+
+def hashFile(filepath):
+    sha = hashlib.sha1()
+    with open(filepath, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hashWeights(names, baseWeights):
+    sha = hashlib.sha1("\n".join(names).encode("utf-8"))
+    sha.update(np.ascontiguousarray(baseWeights, dtype=np.float32).tobytes())
+    return sha.hexdigest()
+
+#
+#   Worker processes
+#
+
+_Names = None
+_BaseWeights = None
+
+def _initWorker(names, baseWeights):
+    global _Names, _BaseWeights
+    _Names = names
+    _BaseWeights = baseWeights
+
+
+def _fitWorker(args):
+    mhclopath,outpath = args
+    try:
+        fitProxy(mhclopath, outpath, _Names, _BaseWeights)
+    except Exception as err:
+        return "%s: %s" % (os.path.basename(mhclopath), err)
+    return None
+
+
+def fitProxy(mhclopath, outpath, names, baseWeights):
+    proxy = CProxy().read(mhclopath)
+    if proxy is None:
+        raise IOError("Cannot read %s" % mhclopath)
+    nRefs = 1 + int(proxy.refIndices.max()) if len(proxy) else 0
+    if nRefs > len(baseWeights):
+        raise ValueError("Proxy refers to vertex %d but the base mesh has %d vertices" % (nRefs-1, len(baseWeights)))
+    saveProxyWeights(outpath, names, proxy.projectWeights(baseWeights))
+
+#
+#   fitProxies(names, baseWeights, folder, outFolder=None, processes=None):
+#
+
+def fitProxies(names, baseWeights, folder, outFolder=None, processes=None):
+    """Fit the weights of all .mhclo files in folder. processes is the
+    number of worker processes, by default one per cpu. With processes=1
+    everything runs in this process. Returns the number of proxies fitted."""
+    if outFolder is None:
+        outFolder = folder
+    if not os.path.isdir(outFolder):
+        os.makedirs(outFolder)
+    manifestPath = os.path.join(outFolder, ManifestFile)
+    try:
+        with open(manifestPath, "r") as fp:
+            manifest = json.load(fp)
+    except (IOError, ValueError):
+        manifest = {}
+
+    baseHash = hashWeights(names, baseWeights)
+    jobs = []
+    hashes = {}
+    for fname in sorted(os.listdir(folder)):
+        stem,ext = os.path.splitext(fname)
+        if ext.lower() != ".mhclo":
+            continue
+        mhclopath = os.path.join(folder, fname)
+        outpath = os.path.join(outFolder, stem + ".weights.json")
+        hashes[fname] = baseHash + ":" + hashFile(mhclopath)
+        if manifest.get(fname) == hashes[fname] and os.path.isfile(outpath):
+            continue
+        jobs.append((fname, mhclopath, outpath))
+
+    print("Fitting %d of %d proxies" % (len(jobs), len(hashes)))
+    args = [(mhclopath,outpath) for _,mhclopath,outpath in jobs]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    if processes == 1:
+        _initWorker(names, baseWeights)
+        errors = [_fitWorker(arg) for arg in args]
+    else:
+        pool = multiprocessing.Pool(processes, _initWorker, (names, baseWeights))
+        try:
+            errors = pool.map(_fitWorker, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    nFitted = 0
+    for (fname,_,_),error in zip(jobs, errors):
+        if error:
+            print("***", error)
+            hashes.pop(fname)
+        else:
+            nFitted += 1
+    # Failed proxies are left out, so they are retried next time
+    saveText(manifestPath, json.dumps(hashes, indent=4, sort_keys=True))
+    print("%d proxies fitted" % nFitted)
+    return nFitted
+
+#
+#   main():
+#
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Fit the weights of all .mhclo proxies in a folder")
+    parser.add_argument("weights", help="base mesh vertex group file (.json)")
+    parser.add_argument("folder", help="folder with .mhclo files")
+    parser.add_argument("outfolder", nargs="?", default=None, help="output folder, default the proxy folder")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+    names,baseWeights = loadBaseWeights(args.weights)
+    fitProxies(names, baseWeights, args.folder, args.outfolder, args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -33,101 +33,67 @@ Abstract
 
 Project to proxy
 
+Weights of all vertex groups are projected at once with proxy.CProxy and
+written back with one call per distinct weight.
+
 """
 
 import bpy
+from bpy.props import *
 import os
+import numpy as np
+from .proxy import CProxy
+from .fit_proxies import fitProxies
+from .export import getBoneName
+from .objfile import writeObj, zupToYup
+from .selection import loadSelectionSets
+from .topology import getTopology, getLoopUVs, weldTexVerts
+from .varia import baseFileGroups
 
 #
-
-#
-#    class CProxy
+#   getWeightMatrix(ob):
+#   setGroupWeights(grp, first, weights):
+#   setVertexWeights(grp, verts, weights):
 #
 
-class CProxy:
-    def __init__(self):
-        self.refVerts = []
-        self.firstVert = 0
-        return
+def getWeightMatrix(ob):
+    """Dense (V,G) matrix with the weights of all vertex groups, built in a
+    single pass over the vertices"""
+    # The group elements are nested per vertex, so foreach_get cannot read
+    # them for the whole mesh
+    me = ob.data
+    verts = []
+    groups = []
+    weights = []
+    for v in me.vertices:
+        for g in v.groups:
+            verts.append(v.index)
+            groups.append(g.group)
+            weights.append(g.weight)
+    matrix = np.zeros((len(me.vertices), len(ob.vertex_groups)), dtype=np.float32)
+    matrix[verts, groups] = weights
+    return matrix
 
-    def setWeights(self, verts, grp):
-        rlen = len(self.refVerts)
-        mlen = len(verts)
-        first = self.firstVert
-        #if (first+rlen) != mlen:
-        #    raise NameError( "Bug: %d refVerts != %d meshVerts" % (first+rlen, mlen) )
-        gn = grp.index
-        print(self, grp, verts)
-        print(rlen, mlen, first)
-        for n in range(rlen):
-            vert = verts[n+first]
-            refVert = self.refVerts[n]
-            if type(refVert) == tuple:
-                (rv0, rv1, rv2, w0, w1, w2, d0, d1, d2) = refVert
-                vw0 = CProxy.getWeight(verts[rv0], gn)
-                vw1 = CProxy.getWeight(verts[rv1], gn)
-                vw2 = CProxy.getWeight(verts[rv2], gn)
-                vw = w0*vw0 + w1*vw1 + w2*vw2
-            else:
-                vw = CProxy.getWeight(verts[refVert], gn)
-            grp.add([vert.index], vw, 'REPLACE')
-        return
 
-    def cornerWeights(self, vn):
-        n = vn - self.firstVert
-        refVert = self.refVerts[n]
-        if type(refVert) == tuple:
-            (rv0, rv1, rv2, w0, w1, w2, d0, d1, d2) = refVert
-            return [(w0,rv0), (w1,rv1), (w2,rv2)]
-        else:
-            return [(1,refVert)]
-
-    def getWeight(vert, gn):
-        for grp in vert.groups:
-            if grp.group == gn:
-                return grp.weight
-        return 0
-
-    def read(self, filepath):
-        realpath = os.path.realpath(os.path.expanduser(filepath))
-        folder = os.path.dirname(realpath)
-        try:
-            tmpl = open(filepath, "rU")
-        except:
-            tmpl = None
-        if tmpl == None:
-            print("*** Cannot open %s" % realpath)
-            return None
-
-        print("Reading", filepath)
-
-        status = 0
-        doVerts = 1
-        vn = 0
-        for line in tmpl:
-            words= line.split()
-            if len(words) == 0:
-                pass
-            elif words[0] == 'verts':
-                if len(words) > 1:
-                    self.firstVert = int(words[1])
-                status = doVerts
-            elif status == doVerts:
-                if len(words) == 1:
-                    v = int(words[0])
-                    self.refVerts.append(v)
-                else:
-                    v0 = int(words[0])
-                    v1 = int(words[1])
-                    v2 = int(words[2])
-                    w0 = float(words[3])
-                    w1 = float(words[4])
-                    w2 = float(words[5])
-                    d0 = float(words[6])
-                    d1 = float(words[7])
-                    d2 = float(words[8])
-                    self.refVerts.append( (v0,v1,v2,w0,w1,w2,d0,d1,d2) )
+def setGroupWeights(grp, first, weights):
+    """Set the weights of vertices first, first+1, ... in grp"""
+    setVertexWeights(grp, np.arange(len(weights)) + first, weights)
+
+
+def setVertexWeights(grp, verts, weights):
+    """Set the weights of the given vertices in grp, adding them to the group
+    if needed. Vertices with exactly the same weight are added in one call."""
+    verts = np.asarray(verts, dtype=np.int32)
+    if len(verts) == 0:
         return
+    weights = np.broadcast_to(weights, verts.shape)
+    values,inverse = np.unique(weights, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind="mergesort")
+    bounds = np.searchsorted(inverse[order], np.arange(len(values)+1))
+    verts = verts[order].tolist()
+    for n,value in enumerate(values.tolist()):
+        grp.add(verts[bounds[n]:bounds[n+1]], value, 'REPLACE')
 
 #
 #   class VIEW3D_OT_ProjectMaterialsButton(bpy.types.Operator):
@@ -135,53 +101,43 @@ class CProxy:
 
 from random import random
 
+def projectFaceAttribute(ob, proxy, faceValues):
+    """Per-face values, e.g. material indices or face group names, with the
+    values of the proxy faces projected from the base mesh"""
+    return proxy.projectFaceValues(getTopology(ob.data), faceValues)
+
+
 class VIEW3D_OT_ProjectMaterialsButton(bpy.types.Operator):
     bl_idname = "mhw.project_materials"
     bl_label = "Project materials from proxy"
 
     def execute(self, context):
         ob = context.object
+        me = ob.data
         proxy = CProxy()
         filepath = os.path.join(os.path.dirname(__file__), "../maketarget/data/a8_v69_clothes.mhclo")
+        if proxy.read(filepath) is None:
+            return{'CANCELLED'}
         grps = baseFileGroups()
-        grpList = set(grps.values())
         grpIndices = {}
-        grpNames = {}
-        n = 0
-        for grp in grpList:
+        for grp in sorted(set(grps.values()) - set([None])):
+            grpIndices[grp] = len(me.materials)
             mat = bpy.data.materials.new(grp)
-            ob.data.materials.append(mat)
+            me.materials.append(mat)
             mat.diffuse_color = (random(), random(), random())
-            grpIndices[grp] = n
-            grpNames[n] = grp
-            n += 1
-
-        vertFaces = {}
-        for v in ob.data.vertices:
-            vertFaces[v.index] = []
-
-        for f in ob.data.polygons:
-            for vn in f.vertices:
-                vertFaces[vn].append(f)
-                if vn >= proxy.firstVert:
-                    grp = None
-                    continue
-                grp = grps[f.index]
-            if grp:
-                f.material_index = grpIndices[grp]
-
-        for f in ob.data.polygons:
-            if f.vertices[0] >= proxy.firstVert:
-                cwts = []
-                for vn in f.vertices:
-                    cwts += proxy.cornerWeights(vn)
-                cwts.sort()
-                cwts.reverse()
-                (w,vn) = cwts[0]
-                for f1 in vertFaces[vn]:
-                    mn = f1.material_index
-                    f.material_index = f1.material_index
-                    continue
+
+        nFaces = len(me.polygons)
+        if nFaces == 0:
+            return{'FINISHED'}
+        mats = np.zeros(nFaces, dtype=np.int32)
+        me.polygons.foreach_get("material_index", mats)
+        topo = getTopology(me)
+        isBase = (np.maximum.reduceat(topo.loopVerts, topo.loopStart) < proxy.firstVert)
+        grpMats = np.array([grpIndices.get(grps.get(fn), -1) for fn in range(nFaces)], dtype=np.int32)
+        mats = np.where(isBase & (grpMats >= 0), grpMats, mats)
+        mats = projectFaceAttribute(ob, proxy, mats)
+        me.polygons.foreach_set("material_index", mats)
+        me.update()
 
         print("Material projected from proxy")
         return{'FINISHED'}
@@ -198,13 +154,37 @@ class VIEW3D_OT_ProjectWeightsButton(bpy.types.Operator):
         ob = context.object
         proxy = CProxy()
         filepath = os.path.join(os.path.dirname(__file__), "../maketarget/data/a8_v69_clothes.mhclo")
-        proxy.read(filepath)
+        if proxy.read(filepath) is None:
+            return{'CANCELLED'}
+        weights = proxy.projectWeights(getWeightMatrix(ob))
         for grp in ob.vertex_groups:
-            print(grp.name)
-            proxy.setWeights(ob.data.vertices, grp)
+            setGroupWeights(grp, proxy.firstVert, weights[:,grp.index])
         print("Weights projected from proxy")
         return{'FINISHED'}
 
+#
+#   class VIEW3D_OT_FitProxiesButton(bpy.types.Operator):
+#
+
+class VIEW3D_OT_FitProxiesButton(bpy.types.Operator):
+    bl_idname = "mhw.fit_proxies"
+    bl_label = "Fit proxy weights"
+    bl_description = "Project the weights of the active mesh onto all .mhclo files in a folder"
+
+    directory = StringProperty(name="Directory", subtype='DIR_PATH', maxlen=1024, default="")
+
+    def execute(self, context):
+        ob = context.object
+        names = [getBoneName(vg) for vg in ob.vertex_groups]
+        # Worker processes would start new Blender instances on some platforms;
+        # use fit_proxies.py from the command line for parallel fitting.
+        fitProxies(names, getWeightMatrix(ob), self.directory, processes=1)
+        return{'FINISHED'}
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
 #
 #
 #
@@ -248,11 +228,19 @@ SkirtBack = [
   [18687, 18688, 18689, 18690, 18701, 18704, 18705, 18706, 18707, 18708, 18720, ]
 ]
 
+def getSkirtRows():
+    sets = loadSelectionSets()
+    rows = sets.getRows("SkirtFront") + sets.getRows("SkirtBack")
+    if rows:
+        return [row.tolist() for row in rows]
+    return SkirtFront + SkirtBack
+
+
 def smoothenSkirt(ob):
     from .vgroup import setupVGroups
     vgroups = setupVGroups(ob)
 
-    for row in SkirtFront + SkirtBack:
+    for row in getSkirtRows():
         verts = [ob.data.vertices[vn] for vn in row]
         orderedVerts = [(v.co[0], v) for v in verts]
         orderedVerts.sort()
@@ -308,116 +296,45 @@ class VIEW3D_OT_SmoothenSkirtButton(bpy.types.Operator):
 
 
 #
-#   exportObjFile(context):
-#   setupTexVerts(ob, scn):
+#   exportObjFile(context, filepath, packed=False):
 #
 
-def exportObjFile(context):
-    fp = open(os.path.join(the3dobjFolder, "base3.obj"), "w")
+def exportObjFile(context, filepath, packed=False):
     scn = context.scene
     me = context.object.data
-    for v in me.vertices:
-        fp.write("v %.4f %.4f %.4f\n" % (v.co[0], v.co[2], -v.co[1]))
-
-    for v in me.vertices:
-        fp.write("vn %.4f %.4f %.4f\n" % (v.normal[0], v.normal[2], -v.normal[1]))
-
-    if me.uv_textures:
-        (uvFaceVerts, texVerts, nTexVerts) = setupTexVerts(me, scn)
-        for vtn in range(nTexVerts):
-            vt = texVerts[vtn]
-            fp.write("vt %.4f %.4f\n" % (vt[0], vt[1]))
-        n = 1
-        mn = -1
-        for f in me.polygons:
-            if f.material_index != mn:
-                mn = f.material_index
-                fp.write("g %s\n" % me.materials[mn].name)
-            uvVerts = uvFaceVerts[f.index]
-            fp.write("f ")
-            for n,v in enumerate(f.vertices):
-                (vt, uv) = uvVerts[n]
-                fp.write("%d/%d " % (v+1, vt+1))
-            fp.write("\n")
+    topo = getTopology(me)
+    coords = np.zeros(3*len(me.vertices), dtype=np.float32)
+    me.vertices.foreach_get("co", coords)
+    normals = np.zeros(3*len(me.vertices), dtype=np.float32)
+    me.vertices.foreach_get("normal", normals)
+    coords = zupToYup(coords)
+    normals = zupToYup(normals)
+
+    if me.uv_layers:
+        loopTexVerts,texVertUVs = weldTexVerts(topo.loopVerts, getLoopUVs(me), scn.MhxEpsilon)
+        faceGroups = np.zeros(len(me.polygons), dtype=np.int32)
+        me.polygons.foreach_get("material_index", faceGroups)
+        groupNames = [mat.name if mat else "" for mat in me.materials]
+        if not groupNames:
+            faceGroups = None
+        writeObj(filepath, coords, normals, topo.loopStart, topo.loopTotal, topo.loopVerts,
+                 texVertUVs, loopTexVerts, faceGroups, groupNames, packed=packed)
     else:
-        for f in me.polygons:
-            fp.write("f ")
-            for vn in f.vertices:
-                fp.write("%d " % (vn+1))
-            fp.write("\n")
-
-    fp.close()
-    print("base3.obj written")
+        writeObj(filepath, coords, normals, topo.loopStart, topo.loopTotal, topo.loopVerts, packed=packed)
+    print(filepath, "written")
     return
 
-def setupTexVerts(me, scn):
-    vertEdges = {}
-    vertFaces = {}
-    for v in me.vertices:
-        vertEdges[v.index] = []
-        vertFaces[v.index] = []
-    for e in me.edges:
-        for vn in e.vertices:
-            vertEdges[vn].append(e)
-    for f in me.polygons:
-        for vn in f.vertices:
-            vertFaces[vn].append(f)
-
-    edgeFaces = {}
-    for e in me.edges:
-        edgeFaces[e.index] = []
-    faceEdges = {}
-    for f in me.polygons:
-        faceEdges[f.index] = []
-    for f in me.polygons:
-        for vn in f.vertices:
-            for e in vertEdges[vn]:
-                v0 = e.vertices[0]
-                v1 = e.vertices[1]
-                if (v0 in f.vertices) and (v1 in f.vertices):
-                    if f not in edgeFaces[e.index]:
-                        edgeFaces[e.index].append(f)
-                    if e not in faceEdges[f.index]:
-                        faceEdges[f.index].append(e)
-
-    faceNeighbors = {}
-    uvFaceVerts = {}
-    for f in me.polygons:
-        faceNeighbors[f.index] = []
-        uvFaceVerts[f.index] = []
-    for f in me.polygons:
-        for e in faceEdges[f.index]:
-            for f1 in edgeFaces[e.index]:
-                if f1 != f:
-                    faceNeighbors[f.index].append((e,f1))
-
-    uvtex = me.uv_textures[0]
-    vtn = 0
-    texVerts = {}
-    for f in me.polygons:
-        uvf = uvtex.data[f.index]
-        vtn = findTexVert(uvf.uv1, vtn, f, faceNeighbors, uvFaceVerts, texVerts, scn)
-        vtn = findTexVert(uvf.uv2, vtn, f, faceNeighbors, uvFaceVerts, texVerts, scn)
-        vtn = findTexVert(uvf.uv3, vtn, f, faceNeighbors, uvFaceVerts, texVerts, scn)
-        if len(f.vertices) > 3:
-            vtn = findTexVert(uvf.uv4, vtn, f, faceNeighbors, uvFaceVerts, texVerts, scn)
-    return (uvFaceVerts, texVerts, vtn)
-
-def findTexVert(uv, vtn, f, faceNeighbors, uvFaceVerts, texVerts, scn):
-    for (e,f1) in faceNeighbors[f.index]:
-        for (vtn1,uv1) in uvFaceVerts[f1.index]:
-            vec = uv - uv1
-            if vec.length < scn.MhxEpsilon:
-                uvFaceVerts[f.index].append((vtn1,uv))
-                return vtn
-    uvFaceVerts[f.index].append((vtn,uv))
-    texVerts[vtn] = uv
-    return vtn+1
-
 class VIEW3D_OT_ExportBaseObjButton(bpy.types.Operator):
     bl_idname = "mhw.export_base_obj"
     bl_label = "Export base3.obj"
 
+    filepath = StringProperty(name="File Path", maxlen=1024, default="base3.obj")
+    packed = BoolProperty(name="Packed Binary", description="Also save the mesh as packed .npz file", default=False)
+
     def execute(self, context):
-        exportObjFile(context)
+        exportObjFile(context, self.properties.filepath, self.packed)
         return{'FINISHED'}
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
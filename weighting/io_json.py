@@ -48,7 +48,7 @@ def loadJson(filepath):
         string = bytes.decode("utf-8")
         struct = json.loads(string)
     else:
-        with open(filepath, "rU") as fp:
+        with open(filepath, "r") as fp:
             struct = json.load(fp)
 
     return struct
@@ -68,6 +68,13 @@ def saveJson(struct, filepath, binary=False, maxDepth=1):
             fp.write("\n")
 
 
+def encodeJson(struct, maxDepth=1, pad=""):
+    """The string saveJson would write for struct, nested at pad"""
+    global _maxDepth
+    _maxDepth = maxDepth
+    return encodeJsonData(struct, 0, pad)
+
+
 def encodeJsonData(data, depth, pad=""):
     global _maxDepth
     if data == None:
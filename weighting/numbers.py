@@ -38,7 +38,38 @@ Vertex and face numbers
 import bpy
 from bpy.props import *
 import os
-from . import io_json
+import numpy as np
+from . import selection
+
+#
+#    getCoords(me):
+#    getSelectedVerts(me):
+#    selectVerts(me, indices):
+#
+
+def getCoords(me):
+    """(V,3) array of vertex coordinates"""
+    coords = np.zeros(3*len(me.vertices), dtype=np.float32)
+    me.vertices.foreach_get("co", coords)
+    return coords.reshape(-1,3)
+
+
+def getSelectedVerts(me):
+    """Indices of the selected vertices, as int32 array"""
+    selected = np.zeros(len(me.vertices), dtype=bool)
+    me.vertices.foreach_get("select", selected)
+    return np.flatnonzero(selected).astype(np.int32)
+
+
+def selectVerts(me, indices, extend=False):
+    """Select the vertices with the given indices, in object mode"""
+    selected = np.zeros(len(me.vertices), dtype=bool)
+    if extend:
+        me.vertices.foreach_get("select", selected)
+    selected[indices] = True
+    me.vertices.foreach_set("select", selected)
+    me.update()
+
 
 #
 #    printVertNums(context):
@@ -66,24 +97,23 @@ class VIEW3D_OT_PrintVnumsToFileButton(bpy.types.Operator):
     bl_label = "Print Vnums To File"
 
     filepath = StringProperty(name="File Path", maxlen=1024, default="")
+    setName = StringProperty(name="Selection Set", description="Name of the set in a .npz selection set library", default="")
 
     def execute(self, context):
         ob = context.object
-        scn = context.scene
+        bpy.ops.object.mode_set(mode='OBJECT')
         fname,ext = os.path.splitext(self.properties.filepath)
-        if ext == ".json":
-            vlist = []
-            for v in ob.data.vertices:
-                if v.select:
-                    vlist.append(v.index)
-            io_json.saveJson(vlist, self.properties.filepath, maxDepth=0)
+        if ext == ".npz":
+            if not self.setName:
+                self.report({'ERROR'}, "No selection set name")
+                return{'CANCELLED'}
+            sets = selection.loadSelectionSets(self.properties.filepath)
+            sets.nVerts = len(ob.data.vertices)
+            sets.add(self.setName, getSelectedVerts(ob.data))
+            sets.save(self.properties.filepath)
         else:
-            fp = open(self.properties.filepath, "w")
-            for v in ob.data.vertices:
-                if v.select:
-                    fp.write("%d\n" % v.index)
-            fp.close()
-        print(self.properties.filepath, "written")
+            selection.saveSelection(getSelectedVerts(ob.data), self.properties.filepath, len(ob.data.vertices))
+            print(self.properties.filepath, "written")
         return{'FINISHED'}
 
     def invoke(self, context, event):
@@ -97,29 +127,26 @@ class VIEW3D_OT_ReadVNumsButton(bpy.types.Operator):
     bl_options = {'UNDO'}
 
     filepath = StringProperty(name="File Path", maxlen=1024, default="")
+    setName = StringProperty(name="Selection Set", description="Name of the set in a .npz selection set library", default="")
 
     def execute(self, context):
-        scn = context.scene
         ob = context.object
+        fname,ext = os.path.splitext(self.properties.filepath)
+        if ext == ".npz":
+            sets = selection.loadSelectionSets(self.properties.filepath)
+            if self.setName not in sets:
+                self.report({'ERROR'}, "No selection set %s in %s" % (self.setName, self.properties.filepath))
+                return{'CANCELLED'}
+            indices = sets.get(self.setName)
+            indices = indices[indices < len(ob.data.vertices)]
+        else:
+            indices = selection.loadSelection(self.properties.filepath, len(ob.data.vertices))
+
         bpy.ops.object.mode_set(mode='EDIT')
         bpy.ops.mesh.select_all(action='DESELECT')
         bpy.ops.object.mode_set(mode='OBJECT')
-
-        fname,ext = os.path.splitext(self.properties.filepath)
-        if ext == ".json":
-            vlist = io_json.loadJson(self.properties.filepath)
-            for vn in vlist:
-                ob.data.vertices[vn].select = True
-        else:
-            fp = open(self.properties.filepath, "rU")
-            for line in fp:
-                try:
-                    vn = int(line)
-                except:
-                    vn = -1
-                if vn >= 0:
-                    ob.data.vertices[vn].select = True
-            fp.close()
+        selectVerts(ob.data, indices)
+        print("%d verts selected" % len(indices))
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -0,0 +1,143 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Bulk OBJ writer
+
+All lines of a kind are formatted with a single format operation, and the
+file is written in one call. Optionally the same data is saved as a packed
+binary .npz file next to the .obj file.
+
+Coordinates are converted from Blender (Z up) to MakeHuman (Y up).
+This module does not use bpy.
+"""
+
+import os
+import numpy as np
+
+#
+#   zupToYup(coords):
+#
+
+def zupToYup(coords):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1,3)
+    return np.column_stack((coords[:,0], coords[:,2], -coords[:,1]))
+
+#
+#   formatLines(fmt, array):
+#   formatFaces(faceStart, faceTotal, faceVerts, faceTexVerts):
+#
+
+def formatLines(fmt, array):
+    """Format every row of a 2D array with fmt, in one operation"""
+    array = np.asarray(array)
+    if len(array) == 0:
+        return ""
+    return (fmt * len(array)) % tuple(array.ravel().tolist())
+
+
+def formatFaces(faceStart, faceTotal, faceVerts, faceTexVerts=None):
+    """Face lines, formatted in runs of consecutive faces with the same number
+    of corners. Indices are 0-based."""
+    nFaces = len(faceStart)
+    if nFaces == 0:
+        return []
+    if faceTexVerts is None:
+        corners = faceVerts[:,None] + 1
+        token = " %d"
+    else:
+        corners = np.column_stack((faceVerts, faceTexVerts)) + 1
+        token = " %d/%d"
+
+    breaks = np.flatnonzero(np.diff(faceTotal)) + 1
+    runStart = np.concatenate(([0], breaks))
+    runEnd = np.concatenate((breaks, [nFaces]))
+    strings = []
+    for first,last in zip(runStart.tolist(), runEnd.tolist()):
+        total = int(faceTotal[first])
+        loops = slice(int(faceStart[first]), int(faceStart[last-1]) + total)
+        strings.append(formatLines("f" + token*total + "\n", corners[loops].reshape(last-first, -1)))
+    return strings
+
+#
+#   writeObj(filepath, coords, normals, faceStart, faceTotal, faceVerts, ...):
+#
+
+def writeObj(filepath, coords, normals, faceStart, faceTotal, faceVerts,
+             texVerts=None, faceTexVerts=None, faceGroups=None, groupNames=None, packed=False):
+    """Write a mesh as OBJ file.
+    faceStart and faceTotal give the first corner and the number of corners
+    of every face, faceVerts and faceTexVerts the vertex and texture vertex of
+    every corner, in face order. If faceGroups is given, a group line with
+    the name in groupNames is written whenever the group changes.
+    If packed is True, all arrays are also saved in a .npz file with the same
+    name."""
+    faceStart = np.asarray(faceStart, dtype=np.int32)
+    faceTotal = np.asarray(faceTotal, dtype=np.int32)
+    faceVerts = np.asarray(faceVerts, dtype=np.int32)
+
+    strings = [
+        formatLines("v %.4f %.4f %.4f\n", coords),
+        formatLines("vn %.4f %.4f %.4f\n", normals),
+    ]
+    if texVerts is not None:
+        strings.append(formatLines("vt %.4f %.4f\n", texVerts))
+
+    if faceGroups is None:
+        strings += formatFaces(faceStart, faceTotal, faceVerts, faceTexVerts)
+    else:
+        faceGroups = np.asarray(faceGroups, dtype=np.int32)
+        breaks = np.flatnonzero(np.diff(faceGroups)) + 1
+        for first,last in zip(np.concatenate(([0], breaks)).tolist(), np.concatenate((breaks, [len(faceGroups)])).tolist()):
+            strings.append("g %s\n" % groupNames[faceGroups[first]])
+            loops = slice(int(faceStart[first]), int(faceStart[last-1] + faceTotal[last-1]))
+            strings += formatFaces(faceStart[first:last] - faceStart[first], faceTotal[first:last], faceVerts[loops],
+                                   None if faceTexVerts is None else faceTexVerts[loops])
+
+    with open(filepath, "w", encoding="utf-8") as fp:
+        fp.write("".join(strings))
+
+    if packed:
+        arrays = {
+            "coords" : np.asarray(coords, dtype=np.float32),
+            "normals" : np.asarray(normals, dtype=np.float32),
+            "faceStart" : faceStart,
+            "faceTotal" : faceTotal,
+            "faceVerts" : faceVerts,
+        }
+        if texVerts is not None:
+            arrays["texVerts"] = np.asarray(texVerts, dtype=np.float32)
+            arrays["faceTexVerts"] = np.asarray(faceTexVerts, dtype=np.int32)
+        if faceGroups is not None:
+            arrays["faceGroups"] = faceGroups
+            arrays["groupNames"] = np.array(groupNames, dtype=str)
+        np.savez(os.path.splitext(filepath)[0] + ".npz", **arrays)
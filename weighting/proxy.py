@@ -0,0 +1,236 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Proxy reference vertices and weight projection
+
+Every proxy vertex refers to three base mesh vertices with barycentric
+weights, stored as (N,3) int32 and (N,3) float32 arrays. Proxy vertices with
+a single reference vertex have weights (1,0,0).
+
+The weights of all vertex groups of the proxy are projected at once from a
+dense (V,G) base weight matrix, which amounts to multiplying with a sparse
+matrix with three entries per row.
+
+The verts section of .mhclo files is parsed with a single np.fromstring
+call, and the arrays are cached in a .npz file next to the .mhclo file.
+
+Per-face values, like materials, are projected onto each proxy face from a
+base face at the reference vertex with the largest weight.
+This module does not use bpy.
+"""
+
+import os
+import numpy as np
+
+try:
+    from .cache import fileStamp, loadCache, saveCache
+except (ImportError, SystemError, ValueError):
+    # Run as a script
+    from cache import fileStamp, loadCache, saveCache
+
+#
+#   projectWeights(refIndices, refWeights, baseWeights):
+#
+
+def projectWeights(refIndices, refWeights, baseWeights):
+    """(N,G) proxy weights from the (V,G) base weight matrix"""
+    weights = refWeights[:,0,None] * baseWeights[refIndices[:,0]]
+    weights += refWeights[:,1,None] * baseWeights[refIndices[:,1]]
+    weights += refWeights[:,2,None] * baseWeights[refIndices[:,2]]
+    return weights
+
+#
+#   dominantRefVerts(loopStart, loopTotal, loopVerts, firstVert, refIndices, refWeights):
+#   projectFaceValues(faceValues, faceRefs, vertFaces):
+#
+
+def dominantRefVerts(loopStart, loopTotal, loopVerts, firstVert, refIndices, refWeights):
+    """The reference vertex with the largest weight over all corners of each
+    proxy face, i.e. face whose first corner is a proxy vertex. Ties go to the
+    highest vertex number. Other faces get -1. Corners must be stored in face
+    order."""
+    nFaces = len(loopStart)
+    faceRefs = -np.ones(nFaces, dtype=np.int32)
+    if nFaces == 0:
+        return faceRefs
+    loopFaces = np.repeat(np.arange(nFaces, dtype=np.int32), loopTotal)
+    isProxy = (loopVerts[loopStart] >= firstVert)
+    loops = np.flatnonzero(isProxy[loopFaces])
+    if len(loops) == 0:
+        return faceRefs
+    pverts = loopVerts[loops] - firstVert
+    faces = np.repeat(loopFaces[loops], 3)
+    refs = refIndices[pverts].ravel()
+    weights = refWeights[pverts].ravel()
+    # The last candidate of every face is the dominant one
+    order = np.lexsort((refs, weights, faces))
+    last = np.flatnonzero(np.append(faces[order][1:] != faces[order][:-1], True))
+    faceRefs[faces[order][last]] = refs[order][last]
+    return faceRefs
+
+
+def projectFaceValues(faceValues, faceRefs, vertFaces):
+    """Copy per-face values to proxy faces from the last face that contains
+    their dominant reference vertex. vertFaces is a CSR (indptr, indices)
+    pair. Other faces keep their values."""
+    values = np.array(faceValues)
+    indptr,indices = vertFaces
+    faces = np.flatnonzero(faceRefs >= 0)
+    faces = faces[indptr[faceRefs[faces]+1] > indptr[faceRefs[faces]]]
+    last = indptr[faceRefs[faces]+1] - 1
+    values[faces] = values[indices[last]]
+    return values
+
+#
+#   class CProxy
+#
+
+class CProxy:
+    def __init__(self):
+        self.firstVert = 0
+        self.refIndices = np.zeros((0,3), dtype=np.int32)
+        self.refWeights = np.zeros((0,3), dtype=np.float32)
+        self.offsets = np.zeros((0,3), dtype=np.float32)
+        return
+
+    def __len__(self):
+        return len(self.refIndices)
+
+    def setRefVerts(self, refIndices, refWeights, offsets):
+        self.refIndices = np.asarray(refIndices, dtype=np.int32).reshape(-1,3)
+        self.refWeights = np.asarray(refWeights, dtype=np.float32).reshape(-1,3)
+        self.offsets = np.asarray(offsets, dtype=np.float32).reshape(-1,3)
+
+    def projectWeights(self, baseWeights):
+        return projectWeights(self.refIndices, self.refWeights, baseWeights)
+
+    def projectFaceValues(self, topo, faceValues):
+        """Per-face values such as material indices or face groups, with the
+        values of the proxy faces taken from the base mesh. topo is a
+        topology.CTopology of the combined mesh."""
+        faceRefs = dominantRefVerts(topo.loopStart, topo.loopTotal, topo.loopVerts,
+            self.firstVert, self.refIndices, self.refWeights)
+        return projectFaceValues(faceValues, faceRefs, topo.vertFaces)
+
+    def cornerWeights(self, vn):
+        n = vn - self.firstVert
+        refs = self.refIndices[n].tolist()
+        wts = self.refWeights[n].tolist()
+        if wts[1] == 0 and wts[2] == 0:
+            return [(1,refs[0])]
+        return list(zip(wts, refs))
+
+    def read(self, filepath, useCache=True):
+        """Read the verts section of a .mhclo file. The arrays are cached in a
+        .npz file next to it, which is used as long as the .mhclo file has the
+        same modification time and size."""
+        realpath = os.path.realpath(os.path.expanduser(filepath))
+        try:
+            stamp = fileStamp(realpath)
+        except OSError:
+            print("*** Cannot open %s" % realpath)
+            return None
+        cachepath = realpath + ".npz"
+
+        data = (loadCache(cachepath, stamp) if useCache else None)
+        if data is not None:
+            try:
+                self.firstVert = int(data["firstVert"])
+                self.setRefVerts(data["refIndices"], data["refWeights"], data["offsets"])
+                return self
+            except (KeyError, ValueError):
+                pass
+
+        print("Reading", filepath)
+        with open(realpath, "r") as fp:
+            lines = fp.read().splitlines()
+        self.firstVert,refIndices,refWeights,offsets = parseVerts(lines)
+        self.setRefVerts(refIndices, refWeights, offsets)
+
+        if useCache:
+            saveCache(cachepath, stamp, firstVert=np.array(self.firstVert),
+                refIndices=self.refIndices, refWeights=self.refWeights, offsets=self.offsets)
+        return self
+
+#
+#   parseVerts(lines):
+#
+
+def parseVerts(lines):
+    """Parse the verts section of the lines of a .mhclo file. The section
+    starts with the line "verts [first]" and ends at the next keyword.
+    Returns firstVert and the (N,3) ref indices, weights and offsets."""
+    firstVert = 0
+    block = []
+    for n,line in enumerate(lines):
+        words = line.split()
+        if words and words[0] == "verts":
+            if len(words) > 1:
+                firstVert = int(words[1])
+            for line in lines[n+1:]:
+                line = line.strip()
+                if line and not (line[0].isdigit() or line[0] in "-+."):
+                    break
+                block.append(line)
+            break
+
+    block = [line for line in block if line]
+    nVerts = len(block)
+    numbers = np.fromstring(" ".join(block), sep=" ") if nVerts else np.zeros(0)
+
+    if len(numbers) == nVerts:
+        # Single reference vertex
+        refIndices = np.repeat(numbers.astype(np.int32)[:,None], 3, axis=1)
+        refWeights = np.zeros((nVerts,3), dtype=np.float32)
+        refWeights[:,0] = 1
+        offsets = np.zeros((nVerts,3), dtype=np.float32)
+    elif len(numbers) == 9*nVerts:
+        numbers = numbers.reshape(nVerts,9)
+        refIndices = numbers[:,0:3].astype(np.int32)
+        refWeights = numbers[:,3:6]
+        offsets = numbers[:,6:9]
+    else:
+        # Mixed single and triple references
+        refIndices = np.zeros((nVerts,3), dtype=np.int32)
+        refWeights = np.zeros((nVerts,3), dtype=np.float32)
+        offsets = np.zeros((nVerts,3), dtype=np.float32)
+        for n,line in enumerate(block):
+            words = line.split()
+            if len(words) == 1:
+                refIndices[n] = int(words[0])
+                refWeights[n,0] = 1
+            else:
+                refIndices[n] = [int(word) for word in words[0:3]]
+                refWeights[n] = [float(word) for word in words[3:6]]
+                offsets[n] = [float(word) for word in words[6:9]]
+    return firstVert, refIndices, refWeights, offsets
@@ -0,0 +1,266 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Vertex selection files
+
+Selections are sorted arrays of vertex indices. They are stored as
+run-length encoded ranges in .vsel files:
+
+    4 bytes     magic "MHVS"
+    3 uint32    version, number of vertices in the mesh (0 if unknown), number of runs
+    int32       first vertex of every run
+    int32       length of every run
+
+The old .json and .txt formats, with one vertex number per entry, can also
+be read and written.
+
+Named selection sets are kept together in one compressed .npz library, with
+the runs of all sets concatenated and an offset table per name. The default
+library is data/selection_sets.npz. This module does not use bpy.
+"""
+
+import os
+import struct
+import numpy as np
+from . import io_json
+
+SelectionMagic = b"MHVS"
+SelectionVersion = 1
+_Header = struct.Struct("<4sIII")
+
+#
+#   encodeRuns(indices):
+#   decodeRuns(starts, lengths):
+#
+
+def encodeRuns(indices):
+    """Run-length encode vertex indices into (starts, lengths) int32 arrays."""
+    indices = np.unique(np.asarray(indices, dtype=np.int32))
+    if len(indices) == 0:
+        empty = np.zeros(0, dtype=np.int32)
+        return empty, empty
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks, [len(indices)]))
+    return indices[first], (last - first).astype(np.int32)
+
+
+def decodeRuns(starts, lengths):
+    """Expand (starts, lengths) runs into a sorted int32 index array."""
+    starts = np.asarray(starts, dtype=np.int32)
+    lengths = np.asarray(lengths, dtype=np.int32)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int32)
+    # Each run continues counting from its start; jumps happen at run boundaries
+    steps = np.ones(total, dtype=np.int32)
+    offsets = np.cumsum(lengths)[:-1]
+    steps[0] = starts[0]
+    steps[offsets] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return np.cumsum(steps, dtype=np.int32)
+
+#
+#   saveSelection(indices, filepath, nVerts=0):
+#   loadSelection(filepath):
+#
+
+def saveSelection(indices, filepath, nVerts=0):
+    fname,ext = os.path.splitext(filepath)
+    if ext == ".json":
+        io_json.saveJson(np.unique(indices).tolist(), filepath, maxDepth=0)
+    elif ext == ".vsel":
+        starts,lengths = encodeRuns(indices)
+        with open(filepath, "wb") as fp:
+            fp.write(_Header.pack(SelectionMagic, SelectionVersion, nVerts, len(starts)))
+            fp.write(starts.astype("<i4").tobytes())
+            fp.write(lengths.astype("<i4").tobytes())
+    else:
+        np.savetxt(filepath, np.unique(indices), fmt="%d")
+
+
+def loadSelection(filepath, nVerts=0):
+    """Read a selection file as a sorted int32 index array. Indices outside
+    the mesh are dropped if nVerts is given."""
+    fname,ext = os.path.splitext(filepath)
+    if ext == ".json":
+        indices = np.array(io_json.loadJson(filepath), dtype=np.int32)
+    elif ext == ".vsel":
+        with open(filepath, "rb") as fp:
+            data = fp.read()
+        magic,version,nSaved,nRuns = _Header.unpack_from(data)
+        if magic != SelectionMagic or version > SelectionVersion:
+            raise RuntimeError("%s is not a valid selection file" % filepath)
+        runs = np.frombuffer(data, dtype="<i4", count=2*nRuns, offset=_Header.size)
+        indices = decodeRuns(runs[:nRuns], runs[nRuns:])
+    else:
+        indices = []
+        with open(filepath, "r") as fp:
+            for line in fp:
+                try:
+                    indices.append(int(line))
+                except ValueError:
+                    pass
+        indices = np.array(indices, dtype=np.int32)
+
+    indices = np.unique(indices)
+    indices = indices[indices >= 0]
+    if nVerts:
+        indices = indices[indices < nVerts]
+    return indices.astype(np.int32)
+
+#
+#   class CSelectionSets:
+#
+
+SelectionSetsFile = os.path.join(os.path.dirname(__file__), "data/selection_sets.npz")
+
+class CSelectionSets:
+    """Named vertex selections, stored together as run-length encoded ranges
+    in a single compressed .npz file. Sets are looked up by name through a
+    dict and only decoded when they are used."""
+
+    def __init__(self, nVerts=0):
+        self.nVerts = nVerts
+        self.mirrorMap = None
+        self.index = {}
+        self.runs = []
+        self.decoded = {}
+        return
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self, prefix=""):
+        return sorted(name for name in self.index.keys() if name.startswith(prefix))
+
+    def get(self, name):
+        try:
+            return self.decoded[name]
+        except KeyError:
+            pass
+        starts,lengths = self.runs[self.index[name]]
+        indices = self.decoded[name] = decodeRuns(starts, lengths)
+        return indices
+
+    def add(self, name, indices):
+        if name in self.index:
+            n = self.index[name]
+        else:
+            n = self.index[name] = len(self.runs)
+            self.runs.append(None)
+        self.runs[n] = encodeRuns(indices)
+        self.decoded.pop(name, None)
+
+    def remove(self, name):
+        n = self.index.pop(name)
+        del self.runs[n]
+        self.decoded.pop(name, None)
+        for key,m in self.index.items():
+            if m > n:
+                self.index[key] = m-1
+
+    def addRows(self, prefix, rows):
+        """Store a table of vertex rows as sets prefix.00, prefix.01, ..."""
+        for n,row in enumerate(rows):
+            self.add("%s.%02d" % (prefix, n), row)
+
+    def getRows(self, prefix):
+        return [self.get(name) for name in self.names(prefix + ".")]
+
+    def union(self, *names):
+        indices = np.zeros(0, dtype=np.int32)
+        for name in names:
+            indices = np.union1d(indices, self.get(name))
+        return indices.astype(np.int32)
+
+    def intersection(self, *names):
+        if not names:
+            return np.zeros(0, dtype=np.int32)
+        indices = self.get(names[0])
+        for name in names[1:]:
+            indices = np.intersect1d(indices, self.get(name), assume_unique=True)
+        return indices.astype(np.int32)
+
+    def difference(self, name, *names):
+        return np.setdiff1d(self.get(name), self.union(*names), assume_unique=True).astype(np.int32)
+
+    def setMirrorMap(self, lverts, rverts, mverts):
+        """Mirror vertex map, from the dicts returned by symmetry.setupVertexPairs"""
+        nVerts = max(self.nVerts, 1 + max([max(verts.keys()) for verts in (lverts, rverts, mverts) if verts] + [-1]))
+        self.mirrorMap = -np.ones(nVerts, dtype=np.int32)
+        for verts in (lverts, rverts, mverts):
+            if verts:
+                self.mirrorMap[list(verts.keys())] = list(verts.values())
+
+    def mirror(self, name):
+        """Mirror image of a set. Vertices without mirror image are dropped."""
+        if self.mirrorMap is None:
+            raise RuntimeError("Selection sets have no mirror map")
+        indices = self.get(name)
+        indices = self.mirrorMap[indices[indices < len(self.mirrorMap)]]
+        return np.unique(indices[indices >= 0]).astype(np.int32)
+
+    def save(self, filepath):
+        names = sorted(self.index.keys(), key=lambda name: self.index[name])
+        lengths = [len(self.runs[self.index[name]][0]) for name in names]
+        arrays = {
+            "names" : np.array(names, dtype=str),
+            "offsets" : np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))),
+            "starts" : np.concatenate([self.runs[self.index[name]][0] for name in names] + [np.zeros(0, dtype=np.int32)]),
+            "lengths" : np.concatenate([self.runs[self.index[name]][1] for name in names] + [np.zeros(0, dtype=np.int32)]),
+            "nverts" : np.array(self.nVerts),
+        }
+        if self.mirrorMap is not None:
+            arrays["mirror"] = self.mirrorMap
+        np.savez_compressed(filepath, **arrays)
+        print(filepath, "written")
+
+
+def loadSelectionSets(filepath=SelectionSetsFile):
+    sets = CSelectionSets()
+    if not os.path.isfile(filepath):
+        return sets
+    with np.load(filepath) as data:
+        sets.nVerts = int(data["nverts"])
+        offsets = data["offsets"]
+        starts = data["starts"]
+        lengths = data["lengths"]
+        for n,name in enumerate(data["names"]):
+            sets.index[str(name)] = n
+            sets.runs.append((starts[offsets[n]:offsets[n+1]], lengths[offsets[n]:offsets[n+1]]))
+        if "mirror" in data.files:
+            sets.mirrorMap = data["mirror"]
+    return sets
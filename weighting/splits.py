@@ -0,0 +1,241 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Split weights
+
+Dense per-vertex weights used to split a target into parts, e.g. Left and
+Right. The weights are kept as an (S,V) matrix with one row per split, so a
+target is split into all parts with one multiply. V is taken from the mesh
+if given, otherwise from the vertex groups; vertices beyond V have weight 0.
+
+Blend masks split the mesh into two sides along an axis, e.g. Left and
+Right, with weights that fall off across a band of given half width around
+the center. Ramps go from 0 to 1 across a selection along a direction, with
+the same falloff curves. All weights are computed from the vertex
+coordinates at once.
+
+Vertex group files like data/vgrp_leftright.json are cached as .npz files
+next to them, keyed by modification time and size.
+This module does not use bpy.
+"""
+
+import os
+import numpy as np
+
+try:
+    from . import io_json
+    from .cache import fileStamp, loadCache, saveCache
+except (ImportError, SystemError, ValueError):
+    # Run as a script
+    import io_json
+    from cache import fileStamp, loadCache, saveCache
+
+DataFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+SplitFiles = [
+    os.path.join(DataFolder, "vgrp_leftright.json"),
+    os.path.join(DataFolder, "vgrp_upper_lower_lip.json"),
+]
+
+#
+#   Blend masks
+#
+
+def linearFalloff(t):
+    return t
+
+def smoothFalloff(t):
+    return t*t*(3 - 2*t)
+
+def sineFalloff(t):
+    return 0.5 - 0.5*np.cos(np.pi*t)
+
+Falloffs = {
+    'LINEAR' : linearFalloff,
+    'SMOOTH' : smoothFalloff,
+    'SINE' : sineFalloff,
+}
+
+# Positive side, negative side, axis and direction in Blender coordinates
+BlendSides = {
+    "LR" : ("Left", "Right", 0, 1),
+    "FB" : ("Front", "Back", 1, -1),
+    "UL" : ("Upper", "Lower", 2, 1),
+}
+
+# Vertex group file of each kind of blend mask
+BlendFiles = {
+    "LR" : SplitFiles[0],
+    "FB" : os.path.join(DataFolder, "vgrp_frontback.json"),
+    "UL" : os.path.join(DataFolder, "vgrp_upperlower.json"),
+}
+
+
+def blendWeights(values, width, falloff='LINEAR', center=0.0):
+    """Weights going from 0 at center-width to 1 at center+width"""
+    t = (np.asarray(values, dtype=np.float64) - center)/(2*width) + 0.5
+    return Falloffs[falloff](np.clip(t, 0.0, 1.0))
+
+
+def blendMasks(coords, kind="LR", width=0.1, falloff='LINEAR', center=0.0):
+    """Names and (2,V) weights of the two sides of a (V,3) coordinate array"""
+    pos,neg,axis,sign = BlendSides[kind]
+    coords = np.asarray(coords).reshape(-1,3)
+    weights = blendWeights(sign*coords[:,axis], width, falloff, sign*center)
+    return [pos, neg], np.vstack((weights, 1-weights))
+
+def rampWeights(coords, direction, falloff='LINEAR'):
+    """Weights going from 0 to 1 along direction, over the extent of coords"""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1,3)
+    if len(coords) == 0:
+        return np.zeros(0)
+    dists = coords.dot(np.asarray(direction, dtype=np.float64))
+    dmin = dists.min()
+    length = dists.max() - dmin
+    if length <= 0:
+        raise ValueError("Selection has no extent along the ramp direction")
+    return Falloffs[falloff]((dists - dmin)/length)
+
+#
+#   class CSplitWeights:
+#
+
+class CSplitWeights:
+    def __init__(self, nVerts=0, dtype=np.float32):
+        self.names = []
+        self.matrix = np.zeros((0,nVerts), dtype=dtype)
+        return
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __getitem__(self, name):
+        return self.matrix[self.names.index(name)]
+
+    @property
+    def nVerts(self):
+        return self.matrix.shape[1]
+
+    def resize(self, nVerts):
+        if nVerts > self.nVerts:
+            matrix = np.zeros((len(self.names), nVerts), dtype=self.matrix.dtype)
+            matrix[:,:self.nVerts] = self.matrix
+            self.matrix = matrix
+
+    def add(self, name, weights):
+        """Add or replace a split. weights is a dense array or a list of
+        (vertex, weight) pairs."""
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim == 2:
+            pairs = weights.reshape(-1,2)
+            verts = pairs[:,0].astype(np.int32)
+            weights = np.zeros(1 + max(verts.max() if len(verts) else -1, self.nVerts-1), dtype=np.float64)
+            weights[verts] = pairs[:,1]
+        self.resize(len(weights))
+        row = np.zeros(self.nVerts, dtype=self.matrix.dtype)
+        row[:len(weights)] = weights
+        if name in self.names:
+            self.matrix[self.names.index(name)] = row
+        else:
+            self.names.append(name)
+            self.matrix = np.vstack((self.matrix, row[None,:]))
+
+    def addVertexGroups(self, filepath, useCache=True):
+        """Add the groups of a vertex group file, {name : [[vertex, weight], ...]}"""
+        stamp = fileStamp(filepath)
+        cachepath = filepath + ".npz"
+        data = (loadCache(cachepath, stamp) if useCache else None)
+        if data is not None and "names" in data and "matrix" in data:
+            for name,weights in zip(data["names"], data["matrix"]):
+                self.add(str(name), weights)
+            return
+
+        groups = io_json.loadJson(filepath)
+        split = CSplitWeights(dtype=np.float64)
+        for name in groups.keys():
+            split.add(name, groups[name])
+        if useCache:
+            saveCache(cachepath, stamp, names=np.array(split.names, dtype=str), matrix=split.matrix)
+        for name,weights in zip(split.names, split.matrix):
+            self.add(name, weights)
+
+    def addBlend(self, coords, kind="LR", width=0.1, falloff='LINEAR', center=0.0):
+        self.resize(len(coords))
+        names,weights = blendMasks(coords, kind, width, falloff, center)
+        for name,row in zip(names, weights):
+            self.add(name, row)
+        return names
+
+    def getWeights(self, indices, names=None):
+        """(S,N) weights of the given vertices, for the named splits or all"""
+        rows = (np.arange(len(self.names)) if names is None else [self.names.index(name) for name in names])
+        indices = np.asarray(indices)
+        weights = np.zeros((len(rows), len(indices)), dtype=self.matrix.dtype)
+        inside = (indices < self.nVerts)
+        weights[:,inside] = self.matrix[rows][:,indices[inside]]
+        return weights
+
+    def apply(self, indices, offsets, names=None):
+        """(S,N,3) offsets scaled by the weights of every split"""
+        return self.getWeights(indices, names)[:,:,None] * offsets[None,:,:]
+
+    def split(self, indices, offsets, names=None, eps=1e-5):
+        """List of (indices, offsets) per split. Vertices whose scaled
+        offset is smaller than eps in all coordinates are dropped."""
+        parts = []
+        for scaled in self.apply(indices, offsets, names):
+            keep = np.any(np.abs(scaled) >= eps, axis=1)
+            parts.append((indices[keep], scaled[keep]))
+        return parts
+
+
+def saveVertexGroups(filepath, split, names=None, minWeight=1e-4):
+    """Save splits in the format of data/vgrp_leftright.json"""
+    lines = []
+    for name in (split.names if names is None else names):
+        weights = np.round(split[name].astype(np.float64), 4)
+        verts = np.flatnonzero(weights >= minWeight)
+        pairs = ("[%d, %g], " * len(verts)) % tuple(np.column_stack((verts, weights[verts])).ravel().tolist())
+        lines.append('    "%s" : [%s]' % (name, pairs[:-2]))
+    with open(filepath, "w", encoding="utf-8") as fp:
+        fp.write("{\n" + ",\n".join(lines) + "\n}\n")
+    print(filepath, "saved")
+
+
+def loadSplitWeights(filepaths=SplitFiles, nVerts=0, dtype=np.float32):
+    split = CSplitWeights(nVerts, dtype)
+    for filepath in filepaths:
+        split.addVertexGroups(filepath)
+    return split
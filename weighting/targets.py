@@ -0,0 +1,103 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Target files
+
+A .target file has one line "n x y z" per displaced vertex. It is read with a
+single np.fromstring call into int32 vertex indices and (N,3) float32
+offsets. The arrays are cached in a .npz file next to the target, which is
+used as long as the target has the same modification time and size. The
+cache keeps the offsets in double precision, so that output written from
+them does not depend on the cache.
+This module does not use bpy.
+"""
+
+import os
+import re
+import numpy as np
+
+try:
+    from .cache import fileStamp, loadCache, saveCache
+except (ImportError, SystemError, ValueError):
+    # Run as a script
+    from cache import fileStamp, loadCache, saveCache
+
+_Comments = re.compile(r"^\s*#.*$", re.MULTILINE)
+
+#
+#   parseTarget(text):
+#   loadTarget(filepath, useCache=True):
+#
+
+def parseTarget(text):
+    text = _Comments.sub("", text)
+    numbers = np.fromstring(text, sep=" ")
+    if len(numbers) % 4:
+        raise ValueError("Target data is not a multiple of 4 numbers")
+    numbers = numbers.reshape(-1,4)
+    return numbers[:,0].astype(np.int32), numbers[:,1:]
+
+
+def loadTarget(filepath, useCache=True, dtype=np.float32):
+    """Vertex indices and (N,3) offsets of a target file"""
+    realpath = os.path.realpath(os.path.expanduser(filepath))
+    stamp = fileStamp(realpath)
+    cachepath = realpath + ".npz"
+
+    data = (loadCache(cachepath, stamp) if useCache else None)
+    if data is not None and "indices" in data and "offsets" in data:
+        return data["indices"], data["offsets"].astype(dtype)
+
+    with open(realpath, "r") as fp:
+        indices,offsets = parseTarget(fp.read())
+    if useCache:
+        saveCache(cachepath, stamp, indices=indices, offsets=offsets)
+    return indices, offsets.astype(dtype)
+
+#
+#   readTarget(filepath, weights=None, eps=1e-5, useCache=True, dtype=np.float32):
+#
+
+def readTarget(filepath, weights=None, eps=1e-5, useCache=True, dtype=np.float32):
+    """Offsets of a target, scaled by a dense per-vertex weight array.
+    Vertices whose scaled offset is smaller than eps in all coordinates
+    are dropped."""
+    indices,offsets = loadTarget(filepath, useCache, dtype)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=dtype)
+        scale = np.zeros(len(indices), dtype=dtype)
+        inside = (indices < len(weights))
+        scale[inside] = weights[indices[inside]]
+        offsets = offsets * scale[:,None]
+    keep = np.any(np.abs(offsets) >= eps, axis=1)
+    return indices[keep], offsets[keep]
@@ -0,0 +1,308 @@
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    https://bitbucket.org/MakeHuman/makehuman-utils
+
+**Authors:**           Thomas Larsson
+
+**Copyright(c):**      MakeHuman Team 2001-2014
+
+**Licensing:**         AGPL3 (http://www.makehuman.org/doc/node/the_makehuman_application.html)
+
+    This file is part of MakeHuman (www.makehuman.org).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Mesh adjacency
+
+Vertex-edge, vertex-vertex, vertex-face, edge-face and face-face adjacency of
+a mesh, stored as CSR arrays: the neighbors of element i are
+indices[indptr[i]:indptr[i+1]].
+
+The index is built with numpy from foreach_get data, and cached by a hash of
+the mesh topology, so it is only built once per mesh.
+
+Selected vertices can be split into rows connected by edges, ordered along
+the edges. Closed loops are split into two rows at their ends in X.
+
+Texture vertices are found by welding the UVs of the face corners of each
+vertex on a hash grid with cell size epsilon.
+"""
+
+import hashlib
+import numpy as np
+
+#
+#   buildCsr(rows, cols, nRows):
+#
+
+def buildCsr(rows, cols, nRows):
+    """CSR (indptr, indices) arrays for the pairs (rows[n], cols[n]), with
+    the columns of each row in the original order."""
+    rows = np.asarray(rows, dtype=np.int32)
+    order = np.argsort(rows, kind="mergesort")
+    indptr = np.zeros(nRows+1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=nRows), out=indptr[1:])
+    return indptr, np.asarray(cols, dtype=np.int32)[order]
+
+#
+#   class CTopology:
+#
+
+class CTopology:
+    def __init__(self, nVerts, edges, loopStart, loopTotal, loopVerts, loopEdges):
+        self.nVerts = nVerts
+        self.nEdges = len(edges)
+        self.nFaces = len(loopStart)
+        self.edges = edges
+        self.loopStart = loopStart
+        self.loopTotal = loopTotal
+        self.loopVerts = loopVerts
+        self.loopEdges = loopEdges
+        self.loopFaces = np.repeat(np.arange(self.nFaces, dtype=np.int32), loopTotal)
+
+        # Face corners are stored contiguously in face order
+        self.faceVerts = (np.append(loopStart, len(loopVerts)).astype(np.int32), loopVerts)
+        self.faceEdges = (self.faceVerts[0], loopEdges)
+
+        ev = edges.ravel()
+        ee = np.repeat(np.arange(self.nEdges, dtype=np.int32), 2)
+        self.vertEdges = buildCsr(ev, ee, nVerts)
+        self.vertVerts = buildCsr(ev, edges[:,::-1].ravel(), nVerts)
+        self.vertFaces = buildCsr(loopVerts, self.loopFaces, nVerts)
+        self.edgeFaces = buildCsr(loopEdges, self.loopFaces, self.nEdges)
+
+        # Every pair of different faces sharing an edge
+        indptr,faces = self.edgeFaces
+        counts = np.diff(indptr)
+        pairCounts = np.repeat(counts, counts)
+        first = np.repeat(np.arange(len(faces), dtype=np.int32), pairCounts)
+        groupStart = np.repeat(np.repeat(indptr[:-1], counts), pairCounts)
+        pairStart = np.repeat(np.cumsum(pairCounts) - pairCounts, pairCounts)
+        second = groupStart + (np.arange(len(first), dtype=np.int32) - pairStart)
+        keep = (faces[first] != faces[second])
+        first = first[keep]
+        second = second[keep]
+        pairEdges = np.repeat(np.repeat(np.arange(self.nEdges, dtype=np.int32), counts), pairCounts)[keep]
+        self.faceFaces = buildCsr(faces[first], faces[second], self.nFaces)
+        self.faceFaceEdges = buildCsr(faces[first], pairEdges, self.nFaces)[1]
+        return
+
+
+    def vertNeighbors(self, vn):
+        indptr,indices = self.vertVerts
+        return indices[indptr[vn]:indptr[vn+1]]
+
+    def vertEdgeList(self, vn):
+        indptr,indices = self.vertEdges
+        return indices[indptr[vn]:indptr[vn+1]]
+
+    def vertFaceList(self, vn):
+        indptr,indices = self.vertFaces
+        return indices[indptr[vn]:indptr[vn+1]]
+
+    def edgeFaceList(self, en):
+        indptr,indices = self.edgeFaces
+        return indices[indptr[en]:indptr[en+1]]
+
+    def faceEdgeList(self, fn):
+        return self.loopEdges[self.loopStart[fn]:self.loopStart[fn]+self.loopTotal[fn]]
+
+    def faceEdgeKeys(self, fn):
+        """Vertex pairs of the face edges, like MeshPolygon.edge_keys"""
+        return [tuple(sorted(key)) for key in self.edges[self.faceEdgeList(fn)].tolist()]
+
+    def faceNeighbors(self, fn):
+        """(edge, face) pairs of the faces sharing an edge with face fn"""
+        indptr,indices = self.faceFaces
+        first,last = indptr[fn],indptr[fn+1]
+        return zip(self.faceFaceEdges[first:last].tolist(), indices[first:last].tolist())
+
+#
+#   vertexRows(topo, verts, coords):
+#
+
+def vertexRows(topo, verts, coords):
+    """Split vertices into rows connected by mesh edges, see orderRows."""
+    verts = np.unique(np.asarray(verts, dtype=np.int32))
+    inside = np.zeros(topo.nVerts, dtype=bool)
+    inside[verts] = True
+    edges = topo.edges[inside[topo.edges[:,0]] & inside[topo.edges[:,1]]]
+
+    # Connected components by propagating the smallest vertex number
+    labels = np.arange(topo.nVerts, dtype=np.int32)
+    while len(edges):
+        low = np.minimum(labels[edges[:,0]], labels[edges[:,1]])
+        if np.all(labels[edges[:,0]] == low) and np.all(labels[edges[:,1]] == low):
+            break
+        np.minimum.at(labels, edges[:,0], low)
+        np.minimum.at(labels, edges[:,1], low)
+
+    rows = []
+    edgeLabels = labels[edges[:,0]]
+    for label in np.unique(labels[verts]):
+        row = verts[labels[verts] == label]
+        rows += orderRows(row, edges[edgeLabels == label], coords)
+    return rows
+
+
+def orderRows(row, rowEdges, coords):
+    """Order a connected set of vertices along its edges. A chain gives one
+    row, starting at the end with the smallest X. A closed loop, like the
+    upper and lower lid sharing the corners of the eye, is split at its
+    vertices with the smallest and largest X into two rows, which both run
+    from the smallest to the largest X. Other trees give one row ordered by
+    X. Other sets with loops raise a ValueError."""
+    if len(row) < 3:
+        return [row[np.argsort(coords[row,0], kind="mergesort")]]
+    neighbors = dict((vn,[]) for vn in row.tolist())
+    for v0,v1 in rowEdges.tolist():
+        neighbors[v0].append(v1)
+        neighbors[v1].append(v0)
+    degrees = np.array([len(nbs) for nbs in neighbors.values()])
+
+    if np.all(degrees == 2):
+        xs = coords[row,0]
+        first,last = row[np.argmin(xs)], row[np.argmax(xs)]
+        if first == last:
+            raise ValueError("Closed loop of %d vertices has no extent in X" % len(row))
+        loop = walkEdges(neighbors, first, len(row))
+        n = loop.index(last)
+        return [np.array(loop[:n+1], dtype=np.int32),
+                np.array([first] + loop[n:][::-1], dtype=np.int32)]
+    elif len(rowEdges) >= len(row):
+        raise ValueError("Closed loop of %d vertices with branches is not supported" % len(row))
+    elif np.all(degrees <= 2):
+        ends = [vn for vn,nbs in neighbors.items() if len(nbs) == 1]
+        first = min(ends, key=lambda vn: coords[vn,0])
+        return [np.array(walkEdges(neighbors, first, len(row)), dtype=np.int32)]
+    else:
+        return [row[np.argsort(coords[row,0], kind="mergesort")]]
+
+
+def walkEdges(neighbors, first, nVerts):
+    """Vertices of a chain or loop in edge order, starting at first"""
+    order = [first]
+    prev,vn = -1,first
+    while len(order) < nVerts:
+        nbs = [nb for nb in neighbors[vn] if nb != prev]
+        prev,vn = vn,nbs[0]
+        order.append(vn)
+    return order
+
+#
+#   weldTexVerts(loopVerts, loopUVs, epsilon):
+#
+
+def weldTexVerts(loopVerts, loopUVs, epsilon):
+    """Merge face corners of the same vertex whose UVs fall in the same grid
+    cell into one texture vertex. Texture vertices are numbered in order of
+    first use. Returns the texture vertex of every corner and the (T,2) UVs
+    of the texture vertices."""
+    loopUVs = np.asarray(loopUVs, dtype=np.float64).reshape(-1,2)
+    if len(loopUVs) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros((0,2), dtype=np.float64)
+    cells = np.floor(loopUVs/epsilon + 0.5).astype(np.int64)
+    keys = np.empty((len(loopUVs),3), dtype=np.int64)
+    keys[:,0] = loopVerts
+    keys[:,1:] = cells
+    keys = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize*3))).ravel()
+    _,first,inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    # Renumber the unique keys in order of first use
+    order = np.argsort(first, kind="mergesort")
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return rank[inverse], loopUVs[first[order]]
+
+
+def getLoopUVs(me, layer=None):
+    """UVs of all face corners as (L,2) array, in face order"""
+    if layer is None:
+        layer = me.uv_layers.active
+    uvs = np.zeros(2*len(me.loops), dtype=np.float32)
+    layer.data.foreach_get("uv", uvs)
+    uvs = uvs.reshape(-1,2)
+    loops = faceOrderLoops(*getFaceLoops(me))
+    if loops is not None:
+        uvs = uvs[loops]
+    return uvs
+
+#
+#   getTopology(me):
+#
+
+_TopologyCache = {}
+_MaxCached = 8
+
+def getFaceLoops(me):
+    loopStart = np.zeros(len(me.polygons), dtype=np.int32)
+    me.polygons.foreach_get("loop_start", loopStart)
+    loopTotal = np.zeros(len(me.polygons), dtype=np.int32)
+    me.polygons.foreach_get("loop_total", loopTotal)
+    return loopStart, loopTotal
+
+
+def faceOrderLoops(loopStart, loopTotal):
+    """Loop indices that put the corners of each face contiguously in face
+    order, or None if they already are"""
+    if len(loopStart) == 0 or np.all(loopStart == np.cumsum(loopTotal) - loopTotal):
+        return None
+    return np.concatenate([np.arange(start, start+total) for start,total in zip(loopStart, loopTotal)])
+
+
+def getMeshArrays(me):
+    nVerts = len(me.vertices)
+    edges = np.zeros(2*len(me.edges), dtype=np.int32)
+    me.edges.foreach_get("vertices", edges)
+    loopStart,loopTotal = getFaceLoops(me)
+    loopVerts = np.zeros(len(me.loops), dtype=np.int32)
+    me.loops.foreach_get("vertex_index", loopVerts)
+    loopEdges = np.zeros(len(me.loops), dtype=np.int32)
+    me.loops.foreach_get("edge_index", loopEdges)
+
+    loops = faceOrderLoops(loopStart, loopTotal)
+    if loops is not None:
+        loopVerts = loopVerts[loops]
+        loopEdges = loopEdges[loops]
+        loopStart = (np.cumsum(loopTotal) - loopTotal).astype(np.int32)
+    return nVerts, edges.reshape(-1,2), loopStart, loopTotal, loopVerts, loopEdges
+
+
+def topologyHash(nVerts, edges, loopStart, loopTotal, loopVerts, loopEdges):
+    sha = hashlib.sha1(str(nVerts).encode("utf-8"))
+    for array in (edges, loopTotal, loopVerts, loopEdges):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+def getTopology(me):
+    """Adjacency index of a Blender mesh, in object mode"""
+    arrays = getMeshArrays(me)
+    key = topologyHash(*arrays)
+    try:
+        return _TopologyCache[key]
+    except KeyError:
+        pass
+    if len(_TopologyCache) >= _MaxCached:
+        _TopologyCache.clear()
+    topo = _TopologyCache[key] = CTopology(*arrays)
+    return topo
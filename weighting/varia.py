@@ -37,6 +37,7 @@ Abstract
 import bpy, os
 from bpy.props import *
 from . import io_json
+from .topology import getTopology
 
 
 def joinMeshes(context):
@@ -355,13 +356,14 @@ def createHairRig(ob):
     for vn in range(18722, 19150):
         hairGroups[vn] = 0
 
+    topo = getTopology(ob.data)
     bones = []
     vgroups = {}
     for f in ob.data.polygons:
         if f.select:
             terminals = []
             vgrp = vgroups[f.index] = []
-            for vn1,vn2 in f.edge_keys:
+            for vn1,vn2 in topo.faceEdgeKeys(f.index):
                 if vn1 not in vgrp:
                     vgrp.append(vn1)
                     hairGroups[vn1] += 1
@@ -37,6 +37,11 @@ Vertex groups
 
 import bpy
 from bpy.props import *
+from .topology import getTopology, vertexRows
+import numpy as np
+from .numbers import getCoords, getSelectedVerts
+from .helpers import setVertexWeights
+from .splits import blendMasks, rampWeights
 
 #
 #    removeVertexGroups(context):
@@ -169,19 +174,12 @@ class VIEW3D_OT_MergeVertexGroupsButton(bpy.types.Operator):
 #
 
 def blurVertexGroups(scn, ob):
-    from makeclothes.makeclothes import setupTexVerts
-    (vertEdges, vertFaces, edgeFaces, faceEdges, faceNeighbors, uvFaceVertsList, texVertsList) = setupTexVerts(ob)
+    topo = getTopology(ob.data)
 
     factor = scn.MhxBlurFactor
     vertWeights = {}
     for v in ob.data.vertices:
-        neighbors = []
-        for e in vertEdges[v.index]:
-            if e.vertices[0] == v.index:
-                neighbors.append(e.vertices[1])
-            else:
-                neighbors.append(e.vertices[0])
-
+        neighbors = topo.vertNeighbors(v.index).tolist()
         nNeighbors = len(neighbors)
         weights = vertWeights[v.index] = {}
         for g in v.groups:
@@ -401,18 +399,16 @@ def findGroupPairs(context):
 
 def pairWeight(context):
     ob = context.object
+    weight = context.scene.MhxWeight
     (group1, group2) = findGroupPairs(context)
-    index1 = group1.index
-    index2 = group2.index
-    for v in ob.data.vertices:
-        if v.select:
-            for grp in v.groups:
-                if grp.index == index1:
-                    grp.weight = weight
-                elif grp.index == index2:
-                    grp.weight = 1-weight
-                else:
-                    ob.remove_from_group(grp, v.index)
+    verts = getSelectedVerts(ob.data)
+    if len(verts) == 0:
+        return
+    for grp in ob.vertex_groups:
+        if grp.index not in (group1.index, group2.index):
+            grp.remove(verts.tolist())
+    setVertexWeights(group1, verts, weight)
+    setVertexWeights(group2, verts, 1-weight)
     return
 
 
@@ -426,23 +422,22 @@ class VIEW3D_OT_PairWeightButton(bpy.types.Operator):
         return{'FINISHED'}
 
 
+def getRampDirection(scn):
+    if scn.MhxRampAxis == 'CUSTOM':
+        return np.array(scn.MhxRampDirection)
+    return np.eye(3)["XYZ".index(scn.MhxRampAxis)]
+
+
 def rampWeight(context):
     ob = context.object
+    scn = context.scene
     (group1, group2) = findGroupPairs(context)
-    xmin = 1e6
-    xmax = -1e6
-    for v in ob.data.vertices:
-        if v.select:
-            x = v.co[0]
-            if x < xmin: xmin = x
-            if x > xmax: xmax = x
-    factor = 1/(xmax-xmin)
-    for v in ob.data.vertices:
-        if v.select:
-            x = v.co[0]
-            w = factor*(x-xmin)
-            group1.add([v.index], 1-w, 'REPLACE')
-            group2.add([v.index], w, 'REPLACE')
+    verts = getSelectedVerts(ob.data)
+    if len(verts) == 0:
+        return
+    weights = rampWeights(getCoords(ob.data)[verts], getRampDirection(scn), scn.MhxRampFalloff)
+    setVertexWeights(group1, verts, 1-weights)
+    setVertexWeights(group2, verts, weights)
     return
 
 
@@ -458,19 +453,14 @@ class VIEW3D_OT_RampWeightButton(bpy.types.Operator):
 
 def createLeftRightGroups(context):
     ob = context.object
-    left = ob.vertex_groups.new(name="Left")
-    right = ob.vertex_groups.new(name="Right")
-    xmax = 0.1
-    factor = 1/(2*xmax)
-    for v in ob.data.vertices:
-        w = factor*(v.co[0]+xmax)
-        if w > 1:
-            left.add([v.index], 1, 'REPLACE')
-        elif w < 0:
-            right.add([v.index], 1, 'REPLACE')
-        else:
-            left.add([v.index], w, 'REPLACE')
-            right.add([v.index], 1-w, 'REPLACE')
+    scn = context.scene
+    names,weights = blendMasks(getCoords(ob.data), scn.MhxBlendSides, scn.MhxBlendWidth, scn.MhxBlendFalloff)
+    for name,row in zip(names, weights):
+        grp = ob.vertex_groups.new(name=name)
+        # Like before, vertices that lie entirely on the other side are not
+        # members of the group
+        verts = np.flatnonzero(row > 0)
+        setVertexWeights(grp, verts, row[verts])
     return
 
 
@@ -484,43 +474,83 @@ class VIEW3D_OT_CreateLeftRightButton(bpy.types.Operator):
         return{'FINISHED'}
 
 
-def weightLid(context, lidname):
-    ob = context.object
-    lid = ob.vertex_groups[lidname]
-    head = ob.vertex_groups["head"]
-    d0 = 0.2
-    d1 = 0.8
-    w0 = 0.0
-
-    row = setupSelected(ob)
-    x0 = row[0][0]
-    x1 = row[-1][0]
-    for x,y,v in row:
-        d = (x-x0)/(x1-x0)
-        w = 1.0
-        if d < d0:
-            w = w0 + d/d0
-        elif d > d1:
-            w = w0 + 1.0 - (d-d1)/(1.0-d1)
-        if w < 0:
-            w = 0.0
-        elif w > 1.0:
-            w = 1.0
-        lid.add([v.index], w, 'REPLACE')
-        head.add([v.index], 1.0-w, 'REPLACE')
-        print(v.index, w)
+#
+#   weightLid(context, lidname):
+#
+#   The selected vertices are split into rows along mesh edges, and each row
+#   is parameterized by arc length. A closed loop around the eye is split at
+#   the corners into the upper and lower lid. A selection of one row weights
+#   that row, one that splits into two rows weights the upper row for uplid
+#   names and the lower row for lolid names. With lidname 'AUTO', the lids of
+#   both eyes are weighted at once: the side is given by X, and the selection
+#   of each side must split into the upper and the lower lid.
+#
 
-    bpy.ops.object.mode_set(mode='EDIT')
+def arcLengths(coords):
+    """Arc length along a row of points, normalized to [0,1]"""
+    if len(coords) < 2:
+        return np.zeros(len(coords))
+    steps = np.sqrt(np.sum(np.diff(coords, axis=0)**2, axis=1))
+    lengths = np.concatenate(([0], np.cumsum(steps)))
+    return lengths/lengths[-1] if lengths[-1] > 0 else lengths
+
+
+def lidWeights(t, d0=0.2, d1=0.8, w0=0.0):
+    """Weights that ramp up over [0,d0], are 1 in between and ramp down over
+    [d1,1]"""
+    w = np.ones(len(t))
+    w = np.where(t < d0, w0 + t/d0, w)
+    w = np.where(t > d1, w0 + 1.0 - (t-d1)/(1.0-d1), w)
+    return np.clip(w, 0.0, 1.0)
 
 
-def setupSelected(ob):
+def getLidRows(ob, lidname):
+    """List of (lid group name, row of vertices)"""
+    me = ob.data
+    coords = getCoords(me)
+    rows = vertexRows(getTopology(me), getSelectedVerts(me), coords)
+    if not rows:
+        raise ValueError("No vertices selected")
+    if lidname != 'AUTO':
+        if len(rows) == 1:
+            return [(lidname, rows[0])]
+        upper,lower = splitLidRows(rows, coords, lidname)
+        if lidname.startswith("uplid"):
+            return [(lidname, upper)]
+        elif lidname.startswith("lolid"):
+            return [(lidname, lower)]
+        raise ValueError("Cannot tell if %s is an upper or lower lid" % lidname)
+    lids = []
+    for suffix,sign in [("L", 1), ("R", -1)]:
+        sideRows = [row for row in rows if sign*coords[row,0].mean() > 0]
+        if sideRows:
+            upper,lower = splitLidRows(sideRows, coords, "side %s" % suffix)
+            lids += [("uplid.%s" % suffix, upper), ("lolid.%s" % suffix, lower)]
+    return lids
+
+
+def splitLidRows(rows, coords, name):
+    """The upper and lower row of a selection that must split into two rows"""
+    if len(rows) != 2:
+        raise ValueError("Selection for %s splits into %d rows, expected the upper and lower lid" % (name, len(rows)))
+    return sorted(rows, key=lambda row: -coords[row,2].mean())
+
+
+def weightLid(context, lidname):
+    ob = context.object
     bpy.ops.object.mode_set(mode='OBJECT')
-    row = []
-    for v in ob.data.vertices:
-        if v.select:
-            row.append((v.co[0],v.co[1],v))
-    row.sort()
-    return row
+    try:
+        coords = getCoords(ob.data)
+        # Look up all groups first, so a missing group leaves no lid half done
+        head = ob.vertex_groups["head"]
+        lids = [(name, ob.vertex_groups[name], row) for name,row in getLidRows(ob, lidname)]
+        for name,lid,row in lids:
+            w = lidWeights(arcLengths(coords[row]))
+            setVertexWeights(lid, row, w)
+            setVertexWeights(head, row, 1.0-w)
+            print("%s: %d verts" % (name, len(row)))
+    finally:
+        bpy.ops.object.mode_set(mode='EDIT')
 
 
 class VIEW3D_OT_WeightLidButton(bpy.types.Operator):
@@ -530,7 +560,14 @@ class VIEW3D_OT_WeightLidButton(bpy.types.Operator):
     lidname = StringProperty()
 
     def execute(self, context):
-        weightLid(context, self.lidname)
+        try:
+            weightLid(context, self.lidname)
+        except ValueError as err:
+            self.report({'ERROR'}, str(err))
+            return{'CANCELLED'}
+        except KeyError as err:
+            self.report({'ERROR'}, "Missing vertex group: %s" % err.args[0])
+            return{'CANCELLED'}
         return{'FINISHED'}
 
 